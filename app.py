@@ -2,21 +2,47 @@
 # Imports
 # ----------------------------------------------------------------------------#
 
-import logging
-import sys
 from datetime import datetime
-from logging import Formatter, FileHandler
+from itertools import groupby
+from operator import itemgetter
 
+import click
 import dateutil.parser
 from babel import dates
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, flash, redirect, url_for
+from flask import (
+    Flask, render_template, request, flash, redirect, url_for, abort, jsonify,
+    Response, stream_with_context
+)
 from flask_migrate import Migrate
 from flask_moment import Moment
 from sqlalchemy import or_
 from sqlalchemy.exc import SQLAlchemyError
-
-from models import setup_db, Venue, Artist, Show
+from sqlalchemy.orm import Query, selectinload
+from sqlalchemy.orm.exc import StaleDataError
+from werkzeug.http import is_resource_modified
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from assets import init_assets
+from choices import choices_changed
+from compression import GzipMiddleware
+from facets import facet_filters, apply_facet_filters, facet_counts
+from home import home_lists, home_entities_deleted, home_shows_listed
+from ical import calendar, feed_version
+from limits import init_limits
+from logs import init_logging
+from matching import matcher, remove_matches
+from metrics import init_metrics
+from models import (
+    setup_db, Venue, Artist, Show, ArchivedShow, genres_venues, genres_artists
+)
+from readmodels import (
+    summary_query, summaries, show_summary_query, show_summaries
+)
+from scheduling import BookingConflict, booking, invalidate_schedules
+from shards import shards
+from snapshots import init_snapshots
+from tasks import executor, after_commit, on_commit
 
 # ----------------------------------------------------------------------------#
 # App Config.
@@ -30,6 +56,21 @@ moment = Moment(app)
 app.config.from_object('config')
 db = setup_db(app)
 migrate = Migrate(app, db)
+shards.init_app(app)
+# the debugger already shows the errors, the logs are for production
+log_handler = None if app.debug else init_logging(app)
+init_assets(app)
+executor.init_app(app)
+init_snapshots(app)
+if app.config['PROXY_COUNT']:
+    # only the addresses added by our proxies are trusted
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_COUNT'])
+app.wsgi_app = GzipMiddleware(app.wsgi_app,
+                               level=app.config['GZIP_LEVEL'],
+                               min_size=app.config['GZIP_MIN_SIZE'])
+init_metrics(app, gzip=app.wsgi_app, log_handler=log_handler)
+# after the metrics and the logs so the refused requests are in them too
+init_limits(app)
 
 
 # ----------------------------------------------------------------------------#
@@ -51,13 +92,137 @@ def format_datetime(value, format_name='medium'):
 app.jinja_env.filters['datetime'] = format_datetime
 
 
+# ----------------------------------------------------------------------------#
+# Helpers.
+# ----------------------------------------------------------------------------#
+
+def materialise(value):
+    """
+        queries of the view data run into lists, in dicts and lists too
+    """
+    if isinstance(value, Query):
+        return value.all()
+    if isinstance(value, dict):
+        return {key: materialise(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [materialise(item) for item in value]
+    return value
+
+
+def render_view(template_name, **context):
+    """
+        render_template once every query of the context has run,
+        with RELEASE_DB_BEFORE_RENDER the sessions are closed before rendering
+        so the connections are back in the pools while the template renders
+        instead of until the end of the request
+    """
+    context = materialise(context)
+    if app.config['RELEASE_DB_BEFORE_RENDER']:
+        shards.close()
+    return render_template(template_name, **context)
+
+
+def request_ids():
+    """
+        ids of a bulk request, either a JSON body {"ids": [1, 2]}
+        or repeated ids form fields
+    """
+    if request.is_json:
+        payload = request.get_json(silent=True)
+        ids = payload.get('ids') if isinstance(payload, dict) else None
+        # a string would be iterated character by character
+        if not isinstance(ids, list):
+            abort(400)
+    else:
+        ids = request.form.getlist('ids')
+    try:
+        ids = [int(_id) for _id in ids]
+    except (TypeError, ValueError):
+        abort(400)
+    if not ids:
+        abort(400)
+    return ids
+
+
+def calendar_response(calendar_name, column, value, among):
+    """
+        streamed iCalendar feed answering 304 to clients polling
+        a feed that didn't change since their last request,
+        among are the shards the shows of the feed can be in
+    """
+    sessions = [shard.session for shard in among]
+    etag, last_modified = feed_version(calendar_name, column, value, sessions)
+    # checked before creating the body as a streamed response
+    # would hold its request context until it's garbage collected
+    if is_resource_modified(request.environ, etag=etag,
+                            last_modified=last_modified):
+        response = Response(
+            stream_with_context(
+                calendar(calendar_name, column, value, sessions)),
+            mimetype='text/calendar'
+        )
+    else:
+        response = Response(status=304)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response
+
+
+def listing_query(model):
+    """
+        venues or artists of the listing pages with their upcoming shows count
+        only the ones with upcoming shows with ?upcoming=1
+    """
+    query = summary_query(model, upcoming_count=True)
+    if request.args.get('upcoming') == '1':
+        query = query.filter(model.upcoming_shows_count > 0)
+    return query
+
+
+def same_shard(form, shard):
+    """
+        a venue keeps the id of its shard so it can't be moved
+        to a state of another one
+    """
+    if shards.for_state(form.state.data) is shard:
+        return True
+    form.state.errors.append(
+        'Venues can\'t be moved to a state of another region')
+    return False
+
+
+def request_k():
+    return min(request.args.get('k', 10, type=int),
+               app.config['MATCHES_LIMIT'])
+
+
+def matches_response(model, matches):
+    # the matcher is built in the background on first use
+    if matches is None:
+        return Response('The matches are being computed, try again later.\n',
+                        503, {'Retry-After': '1'}, mimetype='text/plain')
+    ids = [match_id for match_id, _ in matches]
+    # venues are in the shards of their ids, artists all in main
+    among = list(shards.by_shard(ids)) if model is Venue else [shards.main]
+    names = {}
+    for rows in shards.execute(db.session.query(model.id, model.name).filter(
+            model.id.in_(ids)), among):
+        names.update(rows)
+    return jsonify(matches=[{
+        'id': match_id,
+        'name': names.get(match_id),
+        'score': score
+    } for match_id, score in matches])
+
+
 # ----------------------------------------------------------------------------#
 # Controllers.
 # ----------------------------------------------------------------------------#
 
 @app.route('/')
 def index():
-    return render_template('pages/home.html')
+    return render_view('pages/home.html', **home_lists())
 
 
 #  Venues
@@ -65,45 +230,94 @@ def index():
 
 @app.route('/venues')
 def venues():
+    # a single query for every area, the upcoming shows count included
+    # run in every shard, a state is all in the same one
     data = []
-    areas = db.session.query(Venue.state, Venue.city).distinct()
-    for state, city in areas:
-        # I didn't change key name of upcoming_shows_count
-        # to num_upcoming_shows as it's not used and
-        # if it was used I'll change it from the front-end side
+    upcoming_first = request.args.get('sort') == 'upcoming'
+    venues_list = listing_query(Venue).order_by(Venue.state, Venue.city)
+    if upcoming_first:
+        venues_list = venues_list.order_by(
+            Venue.upcoming_shows_count.desc())
+    venues_list = venues_list.order_by(Venue.id)
+
+    def order(row):
+        return (row['state'], row['city'],
+                -row['upcoming_shows_count'] if upcoming_first else 0,
+                row['id'])
+
+    for (state, city), area_venues in groupby(
+            summaries(shards.merged(venues_list, key=order)),
+            key=lambda v: (v.state, v.city)):
         data.append({
             "city": city,
             "state": state,
-            "venues": Venue.query.filter(Venue.state == state,
-                                         Venue.city == city)
+            "venues": list(area_venues)
         })
-    return render_template('pages/venues.html', areas=data)
+    return render_view('pages/venues.html', areas=data)
 
 
-@app.route('/venues/search', methods=['POST'])
+@app.route('/venues/search', methods=['GET', 'POST'])
 def search_venues():
-    q = request.form.get('search_term', '')
-    venues_query = Venue.query.filter(Venue.name.ilike(f'%{q}%'))
+    # facets links are GET requests while the search box POST
+    q = request.values.get('search_term', '')
+    filters = facet_filters(request.values)
+    venues_query = apply_facet_filters(
+        summary_query(Venue).filter(Venue.name.ilike(f'%{q}%')),
+        Venue, genres_venues, 'venue_id', filters
+    )
 
+    # only the shard of the state when it's filtered on one
+    among = shards.among(filters.get('state'))
+    data = summaries(shards.merged(venues_query.order_by(Venue.id),
+                                   key=itemgetter('id'), shards=among))
     response = {
-        "count": venues_query.count(),
-        "data": venues_query
+        "count": len(data),
+        "data": data,
+        "facets": facet_counts(venues_query, Venue, genres_venues, 'venue_id',
+                               among)
     }
-    return render_template('pages/search_venues.html', results=response,
-                           search_term=q)
+    return render_view('pages/search_venues.html', results=response,
+                       search_term=q, filters=filters)
+
+
+@app.route('/venues/availability')
+def venues_availability():
+    from forms import AvailabilityForm
+    form = AvailabilityForm(formdata=request.args)
+
+    venues_list = None
+    if request.args and form.validate():
+        limit = app.config['AVAILABILITY_RESULTS_LIMIT']
+        venues_list = shards.merged(
+            Venue.available(
+                form.start.data,
+                form.end.data,
+                genre_id=form.genre_id.data,
+                city=form.city.data,
+                state=form.state.data,
+            ).limit(limit),
+            key=itemgetter('id'), shards=shards.among(form.state.data)
+        )[:limit]
+    return render_view('pages/venues_availability.html', form=form,
+                       venues=venues_list)
 
 
 @app.route('/venues/<int:venue_id>')
 def show_venue(venue_id):
-    venue: Venue = Venue.query.get_or_404(venue_id)
-    past_shows = db.session.query(Artist, Show).join(Show).join(Venue). \
+    # the venue, its shows and copies of their artists are in its shard
+    session = shards.for_id(venue_id).session
+    venue: Venue = session.query(Venue).options(
+        selectinload(Venue.genres_relation)).get_or_404(venue_id)
+    past_shows = session.query(Artist, Show).join(Show).join(Venue). \
         filter(
         Show.venue_id == venue_id,
         Show.artist_id == Artist.id,
         Show.start_time < datetime.now()
-    )
+    ).all() + session.query(Artist, ArchivedShow).join(
+        ArchivedShow, ArchivedShow.artist_id == Artist.id
+    ).filter(ArchivedShow.venue_id == venue_id).all()
 
-    upcoming_shows = db.session.query(Artist, Show).join(Show).join(Venue). \
+    upcoming_shows = session.query(Artist, Show).join(Show).join(Venue). \
         filter(
         Show.venue_id == venue_id,
         Show.artist_id == Artist.id,
@@ -128,8 +342,8 @@ def show_venue(venue_id):
             "artist_name": artist.name,
             "artist_image_link": artist.image_link,
             "start_time": show.start_time
-        } for artist, show in past_shows.all()],
-        "past_shows_count": past_shows.count(),
+        } for artist, show in past_shows],
+        "past_shows_count": len(past_shows),
         "upcoming_shows": [{
             'artist_id': artist.id,
             "artist_name": artist.name,
@@ -139,7 +353,24 @@ def show_venue(venue_id):
         "upcoming_shows_count": upcoming_shows.count(),
     }
 
-    return render_template('pages/show_venue.html', venue=data)
+    return render_view('pages/show_venue.html', venue=data)
+
+
+@app.route('/venues/<int:venue_id>/matches')
+def venue_matches(venue_id):
+    return matches_response(
+        Artist, matcher.matches(Venue, venue_id, k=request_k())
+    )
+
+
+@app.route('/venues/<int:venue_id>/calendar.ics')
+def venue_calendar(venue_id):
+    shard = shards.for_id(venue_id)
+    name = shard.session.query(Venue.name).filter(
+        Venue.id == venue_id).scalar()
+    if name is None:
+        abort(404)
+    return calendar_response(name, 'venue_id', venue_id, [shard])
 
 
 @app.route('/venues/create', methods=['GET', 'POST'])
@@ -150,29 +381,34 @@ def create_venue():
 
     if form.validate_on_submit():
         venue = Venue()
-        form.populate_obj(venue)
+        # written in the shard of its state
+        session = shards.for_state(form.state.data).session
         try:
-            db.session.add(venue)
-            db.session.commit()
+            # added first so its genres are loaded in the same session
+            session.add(venue)
+            form.populate_obj(venue)
+            session.commit()
         except SQLAlchemyError:
-            print(sys.exc_info())
-            db.session.rollback()
-            db.session.close()
+            app.logger.exception('Venue could not be created')
+            session.rollback()
+            session.close()
             flash(
                 'An error occurred. Venue '
                 + form.name.data + ' could not be listed.')
-            return render_template('forms/new_venue.html', form=form)
+            return render_view('forms/new_venue.html', form=form)
 
         flash('Venue ' + venue.name + ' was successfully listed!')
         return redirect(url_for('show_venue', venue_id=venue.id))
-    return render_template('forms/new_venue.html', form=form)
+    return render_view('forms/new_venue.html', form=form)
 
 
 @app.route('/venues/<int:venue_id>/edit', methods=['POST', 'GET'])
 def edit_venue(venue_id):
     # it must be imported here to avoid circular import
     from forms import VenueForm
-    venue: Venue = Venue.query.get_or_404(venue_id)
+    shard = shards.for_id(venue_id)
+    session = shard.session
+    venue: Venue = session.query(Venue).get_or_404(venue_id)
     form = VenueForm(obj=venue)
     # and I'm not adding request.form as it's already added by flask-wtf
     # look here https://flask-wtf.readthedocs.io/en/stable/quickstart.html
@@ -186,42 +422,62 @@ def edit_venue(venue_id):
 
     # this function return true only if it's a POST request and it's valid form
     # and choices are validated automatically unless validate_choices = false
-    if form.validate_on_submit():
-        form.populate_obj(venue)
-
+    if form.validate_on_submit() and same_shard(form, shard):
         try:
-            db.session.add(venue)
-            db.session.commit()
+            # the genres setter query can autoflush so it's in the try too
+            form.populate_obj(venue)
+            session.add(venue)
+            session.commit()
+        except StaleDataError:
+            session.rollback()
+            flash('Venue ' + venue_name + ' was changed by someone else '
+                  'while you were editing it, here are its latest details.')
+            venue = session.query(Venue).get_or_404(venue_id)
+            return render_view('forms/edit_venue.html',
+                               form=VenueForm(formdata=None, obj=venue),
+                               venue_name=venue.name), 409
         except SQLAlchemyError:
-            print(sys.exc_info())
-            db.session.rollback()
-            db.session.close()
+            app.logger.exception('Venue %s could not be edited', venue_id)
+            session.rollback()
+            session.close()
             flash(
                 'An error occurred. Venue '
                 + venue_name + ' could not be edited.')
-            return render_template('forms/edit_venue.html', form=form,
-                                   venue_name=venue_name)
+            return render_view('forms/edit_venue.html', form=form,
+                               venue_name=venue_name)
 
         flash('Venue ' + venue.name + ' was successfully updated!')
         return redirect(url_for('show_venue', venue_id=venue_id))
 
-    return render_template('forms/edit_venue.html', form=form,
-                           venue_name=venue_name)
+    return render_view('forms/edit_venue.html', form=form,
+                       venue_name=venue_name)
 
 
 @app.route('/venues/<venue_id>', methods=['DELETE'])
 def delete_venue(venue_id):
-    v = Venue.query.get_or_404(venue_id)
+    # a single DELETE statement, shows and genres are deleted by the
+    # database ON DELETE CASCADE without loading them
+    session = shards.for_id(venue_id).session
     try:
-        db.session.delete(v)
-        db.session.commit()
+        deleted = session.query(Venue).filter(Venue.id == venue_id). \
+            delete(synchronize_session=False)
+        on_commit(invalidate_schedules, [venue_id], session=session)
+        on_commit(choices_changed, 'venue', session=session)
+        after_commit(remove_matches, 'venue', [venue_id], session=session)
+        after_commit(home_entities_deleted, 'venue', [venue_id],
+                     session=session)
+        session.commit()
     except SQLAlchemyError:
-        print(sys.exc_info())
-        db.session.rollback()
-        flash('An error occurred. Venue ' + v.name + ' could not be deleted.')
+        app.logger.exception('Venue %s could not be deleted', venue_id)
+        session.rollback()
+        flash('An error occurred. Venue ' + venue_id
+              + ' could not be deleted.')
         return '', 500
     finally:
-        db.session.close()
+        session.close()
+
+    if not deleted:
+        abort(404)
 
     # BONUS CHALLENGE: Implement a button to delete a Venue
     # on a Venue Page, have it so that clicking that button
@@ -230,47 +486,90 @@ def delete_venue(venue_id):
     return '', 204
 
 
+@app.route('/venues', methods=['DELETE'])
+def delete_venues():
+    ids = request_ids()
+    deleted = 0
+    try:
+        # a transaction per shard, the ones before a failure stay deleted
+        for shard, shard_ids in shards.by_shard(ids).items():
+            session = shard.session
+            deleted += session.query(Venue).filter(
+                Venue.id.in_(shard_ids)).delete(synchronize_session=False)
+            on_commit(invalidate_schedules, shard_ids, session=session)
+            on_commit(choices_changed, 'venue', session=session)
+            after_commit(remove_matches, 'venue', shard_ids, session=session)
+            after_commit(home_entities_deleted, 'venue', shard_ids,
+                         session=session)
+            session.commit()
+    except SQLAlchemyError:
+        app.logger.exception('Venues could not be deleted')
+        session.rollback()
+        return jsonify(error='Venues could not be deleted.'), 500
+    finally:
+        shards.close()
+    return jsonify(deleted=deleted)
+
+
 #  Artists
 #  ----------------------------------------------------------------
 @app.route('/artists')
 def artists():
-    data = db.session.query(Artist.id, Artist.name)
-    return render_template('pages/artists.html', artists=data)
-
-
-@app.route('/artists/search', methods=['POST'])
+    # the shows of an artist can be in every shard, so are their counts
+    counts = shards.upcoming_shows_counts(Show.artist_id)
+    data = summaries(db.session.execute(
+        summary_query(Artist).order_by(Artist.id).statement))
+    for artist in data:
+        artist.upcoming_shows_count = counts.get(artist.id, 0)
+    if request.args.get('upcoming') == '1':
+        data = [artist for artist in data if artist.upcoming_shows_count]
+    if request.args.get('sort') == 'upcoming':
+        # stable so it's still by id for the same count
+        data.sort(key=lambda artist: -artist.upcoming_shows_count)
+    return render_view('pages/artists.html', artists=data)
+
+
+@app.route('/artists/search', methods=['GET', 'POST'])
 def search_artists():
-    q = request.form.get('search_term', '')
-    artists_query = Artist.query.filter(Artist.name.ilike(f'%{q}%'))
+    # facets links are GET requests while the search box POST
+    q = request.values.get('search_term', '')
+    filters = facet_filters(request.values)
+    artists_query = apply_facet_filters(
+        summary_query(Artist).filter(Artist.name.ilike(f'%{q}%')),
+        Artist, genres_artists, 'artist_id', filters
+    )
 
     # I didn't loop throw venues and change upcoming_shows_count
     # because it will take resources for no reason
     # so I would simply change it from the front-end size if it was used
     response = {
         "count": artists_query.count(),
-        "data": artists_query
+        "data": summaries(db.session.execute(
+            artists_query.order_by(Artist.id).statement)),
+        "facets": facet_counts(artists_query, Artist, genres_artists,
+                               'artist_id', [shards.main])
     }
-    return render_template('pages/search_artists.html', results=response,
-                           search_term=q)
+    return render_view('pages/search_artists.html', results=response,
+                       search_term=q, filters=filters)
 
 
 @app.route('/artists/<int:artist_id>')
 def show_artist(artist_id):
-    artist: Artist = Artist.query.get_or_404(artist_id)
-    past_shows = db.session.query(
-        Venue, Show
-    ).join(Show).join(Artist).filter(
-        Show.venue_id == artist_id,
-        Show.artist_id == Artist.id,
-        Show.start_time < datetime.now()
-    )
-    upcoming_shows = db.session.query(
-        Venue, Show
-    ).join(Show).join(Artist).filter(
-        Show.venue_id == artist_id,
-        Show.artist_id == Artist.id,
-        Show.start_time >= datetime.now()
-    )
+    artist: Artist = Artist.query.options(
+        selectinload(Artist.genres_relation)).get_or_404(artist_id)
+
+    # the shows of the artist in every shard, by start time
+    def shows_of(model, *criteria):
+        return shards.merged(db.session.query(
+            Venue.id, Venue.name, Venue.image_link, model.start_time
+        ).join(Venue, Venue.id == model.venue_id).filter(
+            model.artist_id == artist_id, *criteria
+        ).order_by(model.start_time), key=itemgetter(3))
+
+    now = datetime.now()
+    past_shows = shows_of(Show, Show.start_time < now) + \
+        shows_of(ArchivedShow)
+    upcoming_shows = shows_of(Show, Show.start_time >= now)
 
     data = {
         "id": artist.id,
@@ -285,22 +584,40 @@ def show_artist(artist_id):
         "seeking_description": artist.seeking_description,
         "image_link": artist.image_link,
         "past_shows": [{
-            'artist_id': venue.id,
-            "artist_name": venue.name,
-            "artist_image_link": venue.image_link,
-            "start_time": show.start_time
-        } for venue, show in past_shows.all()],
-        "past_shows_count": past_shows.count(),
+            'venue_id': venue_id,
+            "venue_name": venue_name,
+            "venue_image_link": venue_image_link,
+            "start_time": start_time
+        } for venue_id, venue_name, venue_image_link, start_time
+            in past_shows],
+        "past_shows_count": len(past_shows),
         "upcoming_shows": [{
-            'artist_id': venue.id,
-            "artist_name": venue.name,
-            "artist_image_link": venue.image_link,
-            "start_time": show.start_time
-        } for venue, show in upcoming_shows.all()],
-        "upcoming_shows_count": upcoming_shows.count(),
+            'venue_id': venue_id,
+            "venue_name": venue_name,
+            "venue_image_link": venue_image_link,
+            "start_time": start_time
+        } for venue_id, venue_name, venue_image_link, start_time
+            in upcoming_shows],
+        "upcoming_shows_count": len(upcoming_shows),
     }
 
-    return render_template('pages/show_artist.html', artist=data)
+    return render_view('pages/show_artist.html', artist=data)
+
+
+@app.route('/artists/<int:artist_id>/matches')
+def artist_matches(artist_id):
+    return matches_response(
+        Venue, matcher.matches(Artist, artist_id, k=request_k())
+    )
+
+
+@app.route('/artists/<int:artist_id>/calendar.ics')
+def artist_calendar(artist_id):
+    name = db.session.query(Artist.name).filter(
+        Artist.id == artist_id).scalar()
+    if name is None:
+        abort(404)
+    return calendar_response(name, 'artist_id', artist_id, shards.shards)
 
 
 @app.route('/artists/create', methods=['GET', 'POST'])
@@ -311,22 +628,25 @@ def create_artist():
 
     if form.validate_on_submit():
         artist = Artist()
-        form.populate_obj(artist)
         try:
+            # the genres setter query can autoflush so it's in the try too
+            form.populate_obj(artist)
             db.session.add(artist)
             db.session.commit()
         except SQLAlchemyError:
             flash(
                 'An error occurred. Artist '
                 + form.name.data + ' could not be listed.')
-            print(sys.exc_info())
+            app.logger.exception('Artist could not be created')
             db.session.rollback()
             db.session.close()
-            return render_template('forms/new_artist.html', form=form)
+            return render_view('forms/new_artist.html', form=form)
 
+        # the shards have copies of the artists for their shows
+        shards.copy_artists([artist.id])
         flash('Artist ' + artist.name + ' was successfully listed!')
         return redirect(url_for('show_artist', artist_id=artist.id))
-    return render_template('forms/new_artist.html', form=form)
+    return render_view('forms/new_artist.html', form=form)
 
 
 @app.route('/artists/<int:artist_id>/edit', methods=['GET', 'POST'])
@@ -337,48 +657,98 @@ def edit_artist(artist_id):
     form = ArtistForm(obj=artist)
     artist_name = artist.name
     if form.validate_on_submit():
-        form.populate_obj(artist)
         try:
+            # the genres setter query can autoflush so it's in the try too
+            form.populate_obj(artist)
             db.session.add(artist)
             db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            flash('Artist ' + artist_name + ' was changed by someone else '
+                  'while you were editing it, here are its latest details.')
+            artist = Artist.query.get_or_404(artist_id)
+            return render_view('forms/edit_artist.html',
+                               form=ArtistForm(formdata=None, obj=artist),
+                               artist_name=artist.name), 409
         except SQLAlchemyError:
             flash(
                 'An error occurred. Artist '
                 + artist_name + ' could not be edited.'
             )
-            print(sys.exc_info())
+            app.logger.exception('Artist %s could not be edited', artist_id)
             db.session.rollback()
             db.session.close()
-            return render_template('forms/edit_artist.html', form=form,
-                                   artist_name=artist_name)
+            return render_view('forms/edit_artist.html', form=form,
+                               artist_name=artist_name)
+        shards.copy_artists([artist_id])
         return redirect(url_for('show_artist', artist_id=artist_id))
 
-    return render_template('forms/edit_artist.html', form=form,
-                           artist_name=artist_name)
+    return render_view('forms/edit_artist.html', form=form,
+                       artist_name=artist_name)
 
 
 @app.route('/artists/<artist_id>', methods=['DELETE'])
 def delete_artist(artist_id):
-    a = Artist.query.get_or_404(artist_id)
+    # a single DELETE statement, shows and genres are deleted by the
+    # database ON DELETE CASCADE without loading them
     try:
-        db.session.delete(a)
+        deleted = Artist.query.filter(Artist.id == artist_id). \
+            delete(synchronize_session=False)
+        # the artist shows could be in any venue
+        on_commit(invalidate_schedules)
+        on_commit(choices_changed, 'artist')
+        after_commit(remove_matches, 'artist', [artist_id])
+        after_commit(home_entities_deleted, 'artist', [artist_id])
         db.session.commit()
     except SQLAlchemyError:
-        print(sys.exc_info())
+        app.logger.exception('Artist %s could not be deleted', artist_id)
         db.session.rollback()
-        flash('An error occurred. Artist ' + a.name + ' could not be deleted.')
+        flash(
+            'An error occurred. Artist ' + artist_id
+            + ' could not be deleted.')
         db.session.close()
         return '', 500
+
+    if not deleted:
+        abort(404)
+    # their copies, and with them their shows in the other shards
+    shards.delete_artists([artist_id])
     return '', 204
 
 
+@app.route('/artists', methods=['DELETE'])
+def delete_artists():
+    ids = request_ids()
+    try:
+        deleted = Artist.query.filter(Artist.id.in_(ids)). \
+            delete(synchronize_session=False)
+        on_commit(invalidate_schedules)
+        on_commit(choices_changed, 'artist')
+        after_commit(remove_matches, 'artist', ids)
+        after_commit(home_entities_deleted, 'artist', ids)
+        db.session.commit()
+    except SQLAlchemyError:
+        app.logger.exception('Artists could not be deleted')
+        db.session.rollback()
+        return jsonify(error='Artists could not be deleted.'), 500
+    finally:
+        db.session.close()
+    shards.delete_artists(ids)
+    return jsonify(deleted=deleted)
+
+
 #  Shows
 #  ----------------------------------------------------------------
 
 @app.route('/shows')
 def shows():
-    data = db.session.query(Show).join(Artist).join(Venue)
-    return render_template('pages/shows.html', shows=data)
+    # the shows of every shard by start time, then the archived ones
+    data = []
+    for model in (Show, ArchivedShow):
+        data += show_summaries(shards.merged(
+            show_summary_query(model).order_by(model.start_time),
+            key=itemgetter(5)))
+    return render_view('pages/shows.html', shows=data)
 
 
 @app.route('/shows/create', methods=['POST', 'GET'])
@@ -389,20 +759,79 @@ def create_show():
     if form.validate_on_submit():
         show = Show()
         form.populate_obj(show)
+        # written in the shard of its venue
+        session = shards.for_id(show.venue_id).session
         try:
-            db.session.add(show)
-            db.session.commit()
+            with booking(session, show.venue_id,
+                         [(show.start_time, show.end_time)]):
+                session.add(show)
+                session.commit()
+        except BookingConflict as e:
+            session.rollback()
+            session.close()
+            form.start_time.errors.append(str(e))
+            return render_view('forms/new_show.html', form=form)
         except SQLAlchemyError:
-            print(sys.exc_info())
-            db.session.rollback()
-            db.session.close()
+            app.logger.exception('Show could not be created')
+            session.rollback()
+            session.close()
             flash('An error occurred. Show could not be listed.')
-            return render_template('forms/new_show.html', form=form)
+            return render_view('forms/new_show.html', form=form)
 
         flash('Show was successfully listed!')
-        return render_template('pages/home.html')
+        return render_view('pages/home.html')
 
-    return render_template('forms/new_show.html', form=form)
+    return render_view('forms/new_show.html', form=form)
+
+
+@app.route('/shows/recurring/create', methods=['POST', 'GET'])
+def create_recurring_show():
+    from forms import RecurringShowForm
+    form = RecurringShowForm()
+
+    if form.validate_on_submit():
+        occurrences = form.occurrences()
+        # previewing until the user confirms the expanded dates
+        if 'confirm' not in request.form:
+            return render_view('forms/new_recurring_show.html', form=form,
+                               occurrences=occurrences)
+        shard = shards.for_id(form.venue_id.data)
+        session = shard.session
+        duration = form.duration
+        try:
+            with booking(session, form.venue_id.data,
+                         [(o, o + duration) for o in occurrences]):
+                Show.bulk_insert(form.artist_id.data, form.venue_id.data,
+                                 occurrences, duration=duration,
+                                 session=session,
+                                 ids=shard.next_ids(Show.__table__,
+                                                    len(occurrences)))
+                # the bulk insert doesn't return the ids, reloading it lazily
+                on_commit(invalidate_schedules, [form.venue_id.data],
+                          session=session)
+                after_commit(home_shows_listed, int(form.artist_id.data),
+                             int(form.venue_id.data),
+                             sum(o >= datetime.now() for o in occurrences),
+                             session=session)
+                session.commit()
+        except BookingConflict as e:
+            session.rollback()
+            session.close()
+            form.start_time.errors.append(str(e))
+            return render_view('forms/new_recurring_show.html', form=form,
+                               occurrences=occurrences)
+        except SQLAlchemyError:
+            app.logger.exception('Recurring shows could not be created')
+            session.rollback()
+            session.close()
+            flash('An error occurred. Shows could not be listed.')
+            return render_view('forms/new_recurring_show.html', form=form,
+                               occurrences=occurrences)
+
+        flash(f'{len(occurrences)} shows were successfully listed!')
+        return render_view('pages/home.html')
+
+    return render_view('forms/new_recurring_show.html', form=form)
 
 
 @app.route('/shows/search', methods=["POST"])
@@ -410,39 +839,76 @@ def search_shows():
     search_term = request.form.get('search_term', '')
     q = f"%{search_term}%"
 
-    shows_query = db.session.query(Show).join(Artist).join(Venue).filter(or_(
-        Venue.name.ilike(q),
-        Artist.name.ilike(q)
-    ))
+    data = []
+    for model in (Show, ArchivedShow):
+        data += show_summaries(shards.merged(
+            show_summary_query(model).filter(or_(
+                Venue.name.ilike(q),
+                Artist.name.ilike(q)
+            )).order_by(model.start_time),
+            key=itemgetter(5)))
 
     response = {
-        "count": shows_query.count(),
-        "data": shows_query
+        "count": len(data),
+        "data": data
     }
-    return render_template('pages/search_shows.html', results=response,
-                           search_term=search_term)
+    return render_view('pages/search_shows.html', results=response,
+                       search_term=search_term)
 
 
 @app.errorhandler(404)
 def not_found_error(error):
-    return render_template('errors/404.html'), 404
+    return render_view('errors/404.html'), 404
 
 
 @app.errorhandler(500)
 def server_error(error):
-    return render_template('errors/500.html'), 500
+    return render_view('errors/500.html'), 500
 
 
-if not app.debug:
-    f = '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
-    file_handler = FileHandler('error.log')
-    file_handler.setFormatter(
-        Formatter(f)
-    )
-    app.logger.setLevel(logging.INFO)
-    file_handler.setLevel(logging.INFO)
-    app.logger.addHandler(file_handler)
-    app.logger.info('errors')
+# ----------------------------------------------------------------------------#
+# Commands.
+# ----------------------------------------------------------------------------#
+
+@app.cli.group('shows')
+def shows_commands():
+    """Shows commands."""
+
+
+@shows_commands.command('archive')
+@click.option('--batch-size', default=1000, show_default=True)
+def archive_shows(batch_size):
+    """
+        Move past shows to the archive table, meant to run from cron
+        so the shows table only keeps upcoming shows.
+    """
+    before = datetime.now()
+    total = 0
+    for shard in shards.shards:
+        while True:
+            moved = ArchivedShow.archive_batch(before, batch_size,
+                                               session=shard.session)
+            if not moved:
+                break
+            total += moved
+            click.echo(f'archived {total} shows')
+
+
+@app.cli.group('shards')
+def shards_commands():
+    """Shards commands."""
+
+
+@shards_commands.command('init')
+def init_shards():
+    """
+        Create the tables of the shards with their ids sequences and copy
+        the genres and the artists to them, run it again to copy them over
+        if a copy failed.
+    """
+    shards.create_all()
+    click.echo(f'{len(shards.others)} shards initialized')
+
 
 # ----------------------------------------------------------------------------#
 # Launch.
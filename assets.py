@@ -0,0 +1,167 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+
+import click
+from flask import current_app, request, send_from_directory, url_for
+
+# Bundles referenced by layouts/main.html
+# the order matters as it's the order they are concatenated in
+BUNDLES = {
+    'main.css': [
+        'css/bootstrap.min.css',
+        'css/layout.main.css',
+        'css/main.css',
+        'css/main.responsive.css',
+        'css/main.quickfix.css',
+    ],
+    'head.js': [
+        'js/libs/modernizr-2.8.2.min.js',
+        'js/libs/moment.min.js',
+        'js/script.js',
+    ],
+    'footer.js': [
+        'js/libs/bootstrap-3.1.1.min.js',
+        'js/plugins.js',
+    ],
+}
+
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+# a year, it's safe as file names change whenever their content change
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def minify_css(source):
+    source = re.sub(r'/\*.*?\*/', '', source, flags=re.S)
+    source = re.sub(r'\s+', ' ', source)
+    source = re.sub(r'\s*([{};:,>])\s*', r'\1', source)
+    return source.replace(';}', '}').strip()
+
+
+def minify_js(source):
+    """
+        conservative minification, only dropping whole line comments,
+        indentation and empty lines,
+        the libs are already minified so there is not much to gain
+        from parsing javascript here
+    """
+    lines = []
+    for line in source.splitlines():
+        line = line.strip()
+        if line and not line.startswith('//'):
+            lines.append(line)
+    return '\n'.join(lines)
+
+
+def build_bundle(static_folder, name, files):
+    """
+        concatenate and minify the bundle files
+        then write it with a content hashed name and a gzip sibling
+        returns the hashed file name relative to the static folder
+    """
+    minify = minify_css if name.endswith('.css') else minify_js
+    # js files are joined with ; in case any of them doesn't end with one
+    separator = '\n' if name.endswith('.css') else ';\n'
+    parts = []
+    for file in files:
+        with open(os.path.join(static_folder, file), encoding='utf-8') as f:
+            parts.append(minify(f.read()))
+    content = separator.join(parts).encode('utf-8')
+
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    base, ext = os.path.splitext(name)
+    hashed_name = f'{DIST_DIR}/{base}.{digest}{ext}'
+
+    path = os.path.join(static_folder, hashed_name)
+    with open(path, 'wb') as f:
+        f.write(content)
+    # mtime=0 to make the compressed output reproducible between builds
+    with open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(content, compresslevel=9, mtime=0))
+    return hashed_name
+
+
+def build_assets(static_folder):
+    dist = os.path.join(static_folder, DIST_DIR)
+    os.makedirs(dist, exist_ok=True)
+    # removing old builds so they don't pile up between deploys
+    for file in os.listdir(dist):
+        os.remove(os.path.join(dist, file))
+
+    manifest = {
+        name: build_bundle(static_folder, name, files)
+        for name, files in BUNDLES.items()
+    }
+    with open(os.path.join(dist, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def load_manifest(static_folder):
+    try:
+        with open(os.path.join(static_folder, DIST_DIR, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def asset_urls(name):
+    """
+        urls of a bundle, a single fingerprinted url if the assets are built
+        or the original files otherwise so it keeps working in development
+    """
+    manifest = current_app.extensions['assets']
+    if name in manifest:
+        return [url_for('static', filename=manifest[name])]
+    return [url_for('static', filename=file) for file in BUNDLES[name]]
+
+
+def send_dist_file(filename):
+    """
+        serve the pre-compressed sibling if the client accepts it
+        so we never compress static files on the fly
+    """
+    static_folder = current_app.static_folder
+    gz_path = os.path.join(static_folder, DIST_DIR, filename + '.gz')
+    use_gzip = ('gzip' in request.headers.get('Accept-Encoding', '')
+                and os.path.isfile(gz_path))
+
+    response = send_from_directory(
+        os.path.join(static_folder, DIST_DIR),
+        filename + '.gz' if use_gzip else filename,
+        mimetype='text/css' if filename.endswith('.css')
+        else 'application/javascript',
+        cache_timeout=IMMUTABLE_MAX_AGE,
+        conditional=True,
+    )
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = \
+        f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    return response
+
+
+def init_assets(app):
+    app.extensions['assets'] = load_manifest(app.static_folder)
+    app.jinja_env.globals['asset_urls'] = asset_urls
+    # it's more specific than the static rule so werkzeug matches it first
+    app.add_url_rule(
+        f'{app.static_url_path}/{DIST_DIR}/<path:filename>',
+        endpoint='dist', view_func=send_dist_file
+    )
+
+    @app.cli.group()
+    def assets():
+        """Static assets commands."""
+
+    @assets.command('build')
+    def build():
+        """Concatenate, minify and fingerprint the static bundles."""
+        manifest = build_assets(app.static_folder)
+        app.extensions['assets'] = manifest
+        for name, hashed_name in manifest.items():
+            click.echo(f'{name} -> {hashed_name}')
@@ -0,0 +1,102 @@
+"""
+    Benchmark of a 10k venues search results page,
+    full ORM entities (with the genres joined as they used to be,
+    and lazily as they are now) against the Summary read models
+    built from a column only query, time and memory per page
+
+    run it from the project root with: python -m benchmarks.listings
+"""
+import argparse
+import os
+import time
+import tracemalloc
+
+# it must be set before importing the app to use a throwaway database
+os.environ.setdefault('DATABASE_URI', 'sqlite://')
+
+from sqlalchemy.orm import joinedload  # noqa: E402
+
+from app import app  # noqa: E402
+from models import db, Genre, Venue, genres_venues  # noqa: E402
+from readmodels import summary_query, summaries  # noqa: E402
+
+GENRES_PER_VENUE = 3
+
+
+def setup(size):
+    db.drop_all()
+    db.create_all()
+    db.session.execute(Genre.__table__.insert(), [
+        {'id': i, 'name': f'Genre {i}'} for i in range(1, 11)
+    ])
+    db.session.execute(Venue.__table__.insert(), [{
+        'id': i,
+        'name': f'Venue {i}',
+        'city': 'Austin',
+        'state': 'TX',
+        'address': f'{i} Street',
+        'image_link': f'https://example.com/venues/{i}.png',
+        'seeking_description': 'Looking for artists ' * 50,
+    } for i in range(1, size + 1)])
+    db.session.execute(genres_venues.insert(), [
+        {'venue_id': i, 'genre_id': g}
+        for i in range(1, size + 1) for g in range(1, GENRES_PER_VENUE + 1)
+    ])
+    db.session.commit()
+
+
+def search():
+    return Venue.name.ilike('%Venue%')
+
+
+def joined_entities():
+    return Venue.query.options(joinedload(Venue.genres_relation)).filter(
+        search()).order_by(Venue.id).all()
+
+
+def entities():
+    return Venue.query.filter(search()).order_by(Venue.id).all()
+
+
+def read_models():
+    return summaries(db.session.execute(
+        summary_query(Venue).filter(search()).order_by(Venue.id).statement))
+
+
+def measure(load):
+    # what the template reads of every result
+    def page():
+        return [(v.id, v.name) for v in load()]
+
+    best = float('inf')
+    for _ in range(3):
+        db.session.remove()
+        start = time.perf_counter()
+        page()
+        best = min(best, time.perf_counter() - start)
+    db.session.remove()
+    tracemalloc.start()
+    rows = load()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(rows), best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=10_000)
+    args = parser.parse_args()
+
+    with app.app_context():
+        setup(args.size)
+        for name, load in (('joined genres', joined_entities),
+                           ('entities', entities),
+                           ('read models', read_models)):
+            count, elapsed, peak = measure(load)
+            assert count == args.size
+            print(f'{name:>13}: {count} rows in {elapsed * 1000:.1f}ms, '
+                  f'{peak / 1024 / 1024:.1f}MB peak')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+    Benchmark of the blocked artist venue matching at 100k x 100k,
+    scoring every pair takes a while so by default only a sample
+    of the artists is scored against all the venues and the time
+    is extrapolated, pass --rows 100000 to score all of them
+
+    run it from the project root with: python -m benchmarks.matching
+"""
+import argparse
+import time
+
+import numpy as np
+
+from matching import Matcher, MatchIndex, ROWS_BLOCK
+from models import Artist
+
+GENRES = 20
+STATES = 51
+CITIES_PER_STATE = 20
+
+
+def fill(index, matrix, size, rng):
+    for entity_id in range(1, size + 1):
+        genres = rng.choice(GENRES, size=rng.integers(1, 4), replace=False) + 1
+        state = int(rng.integers(STATES))
+        city = f'city {rng.integers(CITIES_PER_STATE)}'
+        index._set(matrix, entity_id, genres, city, state)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--artists', type=int, default=100_000)
+    parser.add_argument('--venues', type=int, default=100_000)
+    parser.add_argument('--rows', type=int, default=ROWS_BLOCK * 4,
+                        help='artists actually scored')
+    parser.add_argument('-k', type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    index = MatchIndex()
+    start = time.perf_counter()
+    fill(index, index.artists, args.artists, rng)
+    fill(index, index.venues, args.venues, rng)
+    matcher = Matcher()
+    matcher._index = index
+    print(f'built {args.artists} x {args.venues} matrices '
+          f'in {time.perf_counter() - start:.1f}s')
+
+    rows = min(args.rows, args.artists)
+    start = time.perf_counter()
+    for block in range(0, rows, ROWS_BLOCK):
+        Matcher._top_k(index.artists, slice(block, min(block + ROWS_BLOCK,
+                                                       rows)),
+                       index.venues, args.k)
+    elapsed = time.perf_counter() - start
+    pairs = rows * args.venues
+    print(f'scored {pairs:,} pairs in {elapsed:.2f}s '
+          f'({pairs / elapsed / 1e6:.0f}M pairs/s)')
+    print(f'estimated top {args.k} for all {args.artists} artists: '
+          f'{elapsed * args.artists / rows:.0f}s')
+
+    start = time.perf_counter()
+    matcher.matches(Artist, 1, k=args.k)
+    print(f'single artist top {args.k}: '
+          f'{(time.perf_counter() - start) * 1000:.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+    Benchmark of listing a 1k occurrences residency,
+    one ORM insert and commit per show (what 1k ShowForm submits do)
+    against the single bulk INSERT used by /shows/recurring/create
+
+    run it from the project root with: python -m benchmarks.recurring_shows
+"""
+import os
+import time
+from datetime import datetime
+
+# it must be set before importing the app to use a throwaway database
+os.environ.setdefault('DATABASE_URI', 'sqlite://')
+
+from app import app  # noqa: E402
+from models import db, Show, Venue, Artist  # noqa: E402
+from recurrence import expand, MAX_OCCURRENCES  # noqa: E402
+
+
+def setup():
+    db.drop_all()
+    db.create_all()
+    venue = Venue(name='Venue', city='Austin', state='TX', address='Street',
+                  image_link='https://example.com/venue.png')
+    artist = Artist(name='Artist', city='Austin', state='TX',
+                    image_link='https://example.com/artist.png')
+    db.session.add_all([venue, artist])
+    db.session.commit()
+    return artist.id, venue.id
+
+
+def one_by_one(artist_id, venue_id, occurrences):
+    for start_time in occurrences:
+        db.session.add(Show(artist_id=artist_id, venue_id=venue_id,
+                            start_time=start_time))
+        db.session.commit()
+
+
+def bulk(artist_id, venue_id, occurrences):
+    Show.bulk_insert(artist_id, venue_id, occurrences)
+    db.session.commit()
+
+
+def main():
+    occurrences = expand(datetime(2030, 1, 4, 20), 'weekly',
+                         count=MAX_OCCURRENCES)
+    with app.app_context():
+        for name, insert in (('one by one', one_by_one), ('bulk', bulk)):
+            ids = setup()
+            start = time.perf_counter()
+            insert(*ids, occurrences)
+            elapsed = time.perf_counter() - start
+            assert Show.query.count() == len(occurrences)
+            print(f'{name:>12}: {len(occurrences)} shows '
+                  f'in {elapsed * 1000:.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+import threading
+import time
+from collections import OrderedDict
+
+# every cache created, to report their hit ratios
+registry = []
+
+
+class LRUCache(object):
+    """
+        thread safe least recently used cache counting its hits and misses
+    """
+
+    def __init__(self, name, maxsize=10000):
+        self.name = name
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            return self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def dump(self):
+        with self._lock:
+            return list(self._data.items()) or None
+
+    def restore(self, items):
+        # entries are keyed by what they are made of so outdated ones
+        # are never hit and end up evicted
+        for key, value in items:
+            self.set(key, value)
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class CachedValue(object):
+    """
+        value loaded on first use and served from memory,
+        `version` gives the version of the data it's loaded from,
+        checked at most every `ttl` seconds so the changes made by the
+        other processes are seen, it's reloaded once it changed
+    """
+
+    def __init__(self, name, load, version, ttl=5):
+        self.name = name
+        self.load = load
+        self.version = version
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._value = None
+        self._version = None
+        self._checked_at = None
+        # bumped by expire so a value loaded meanwhile isn't kept
+        self._generation = 0
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def get(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._value is not None and self._checked_at is not None \
+                    and now - self._checked_at <= self.ttl:
+                self.hits += 1
+                return self._value
+            value, generation = self._value, self._generation
+            loaded_version = self._version
+        version = self.version()
+        if value is not None and version == loaded_version:
+            with self._lock:
+                if generation == self._generation:
+                    self._checked_at = now
+                self.hits += 1
+            return value
+        value = self.load()
+        with self._lock:
+            self.misses += 1
+            if generation == self._generation:
+                self._value = value
+                self._version = version
+                self._checked_at = now
+        return value
+
+    def expire(self):
+        """
+            reloaded on the next get, for the changes of this process
+        """
+        with self._lock:
+            self._value = None
+            self._generation += 1
+
+    def dump(self):
+        with self._lock:
+            if self._value is None:
+                return None
+            return {'version': self._version, 'value': self._value}
+
+    def restore(self, snapshot):
+        """
+            value of a snapshot, its version is checked on the first get
+        """
+        with self._lock:
+            self._value = snapshot['value']
+            self._version = snapshot['version']
+            self._checked_at = None
+
+    def __len__(self):
+        value = self._value
+        return len(value) if value is not None else 0
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class TopN(object):
+    """
+        first `size` items of a list ordered by `key`, biggest first,
+        served from memory and patched in place as the data changes,
+        once older than `ttl` seconds it's reported stale to be reloaded
+        items are dicts with an id, `version` gives the version
+        of the data they are loaded from
+    """
+
+    def __init__(self, name, load, key, size=10, ttl=300, version=None):
+        self.name = name
+        self.load = load
+        self.key = key
+        self.size = size
+        self.ttl = ttl
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.items = []
+        self.loaded_at = None
+        self._version = None
+        # wall clock time it was loaded at, to be compared across restarts
+        self._loaded_on = None
+        # snapshot restored, used by the next reload if it's still valid
+        self._snapshot = None
+        self._reload_at = None
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def get(self):
+        """
+            the items and whether it's time to reload them
+            only the first caller of a stale list is told to reload it,
+            unless the reload didn't happen within ttl seconds
+        """
+        now = time.monotonic()
+        with self._lock:
+            stale = self.loaded_at is None or now - self.loaded_at > self.ttl
+            if stale:
+                self.misses += 1
+            else:
+                self.hits += 1
+            reload = stale and (self._reload_at is None
+                                or now - self._reload_at > self.ttl)
+            if reload:
+                self._reload_at = now
+            return self.items, reload
+
+    def reload(self):
+        with self._lock:
+            snapshot, self._snapshot = self._snapshot, None
+        version = self.version() if self.version is not None else None
+        loaded_on = time.time()
+        if snapshot is not None and snapshot['version'] == version \
+                and 0 <= loaded_on - snapshot['loaded_on'] <= self.ttl:
+            items, loaded_on = snapshot['items'], snapshot['loaded_on']
+        else:
+            items = self.load(self.size)
+        with self._lock:
+            self.items = items
+            self._version = version
+            self._loaded_on = loaded_on
+            self.loaded_at = time.monotonic() - (time.time() - loaded_on)
+            self._reload_at = None
+
+    def expire(self):
+        with self._lock:
+            self.loaded_at = None
+
+    def dump(self):
+        # an empty list doesn't replace the snapshot of a busier worker
+        with self._lock:
+            if not self.items or self._loaded_on is None:
+                return None
+            return {'version': self._version, 'loaded_on': self._loaded_on,
+                    'items': self.items}
+
+    def restore(self, snapshot):
+        """
+            items of a snapshot, taken by the reload the first get
+            triggers if their data didn't change and they are not older
+            than ttl, they aren't served before
+        """
+        with self._lock:
+            self._snapshot = snapshot
+            self.loaded_at = None
+
+    def _set(self, items):
+        # a new list so the readers never see it half updated
+        self.items = sorted(items, key=self.key, reverse=True)[:self.size]
+
+    def upsert(self, item):
+        """
+            item added or replaced, it's dropped if it doesn't make it
+            to the first `size` ones
+        """
+        with self._lock:
+            self._set([i for i in self.items if i['id'] != item['id']]
+                      + [item])
+
+    def update(self, item_id, change):
+        """
+            item replaced by change(item) if it's in the list,
+            returns whether it was
+        """
+        with self._lock:
+            found = any(i['id'] == item_id for i in self.items)
+            if found:
+                self._set([change(i) if i['id'] == item_id else i
+                           for i in self.items])
+            return found
+
+    def remove(self, ids):
+        with self._lock:
+            self.items = [i for i in self.items if i['id'] not in ids]
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
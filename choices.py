@@ -0,0 +1,48 @@
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+from caches import CachedValue
+from models import db, Artist, Venue
+from shards import shards
+from tasks import on_commit
+
+
+def _venues_choices():
+    return [
+        (str(venue_id), f"ID:{venue_id} {name}")
+        for venue_id, name in shards.merged(
+            db.session.query(Venue.id, Venue.name).order_by(Venue.id),
+            key=lambda row: row[0]
+        )
+    ]
+
+
+# the show form selects, from every shard for the venues
+CHOICES = {
+    'artist': CachedValue('artist_choices', Artist.artists_choices,
+                          lambda: shards.version(Artist)),
+    'venue': CachedValue('venue_choices', _venues_choices,
+                         lambda: shards.version(Venue)),
+}
+
+
+def choices(kind):
+    """
+        (id, label) of every artist or venue, kept in memory
+        until one is added, edited or deleted
+    """
+    return CHOICES[kind].get()
+
+
+def choices_changed(kind):
+    CHOICES[kind].expire()
+
+
+@event.listens_for(Artist, 'after_insert')
+@event.listens_for(Artist, 'after_update')
+@event.listens_for(Venue, 'after_insert')
+@event.listens_for(Venue, 'after_update')
+def _entity_saved(mapper, connection, target):
+    # right after the commit so the next form of this thread has it
+    on_commit(choices_changed, target.__model_name__,
+              session=object_session(target))
@@ -0,0 +1,202 @@
+import logging
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIBLE_MIMETYPES = (
+    'text/',
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'image/svg+xml',
+)
+
+
+def accepts_gzip(accept_encoding):
+    """
+        checking the header ourselves as werkzeug's accept classes
+        would parse the whole environ for a single header,
+        gzip itself takes precedence over *
+    """
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        coding = coding.strip().lower()
+        if coding not in ('gzip', '*'):
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    return qualities.get('gzip', qualities.get('*', 0.0)) > 0
+
+
+class GzipMiddleware(object):
+    """
+        gzip WSGI middleware compressing the body chunk by chunk
+        so streamed and generator responses keep being streamed,
+        responses without a Content-Length are buffered only until
+        min_size is reached to decide if they are worth compressing
+    """
+
+    def __init__(self, app, level=6, min_size=500):
+        self.app = app
+        self.level = level
+        self.min_size = min_size
+        self._lock = threading.Lock()
+        self.stats = {
+            'responses': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+            'cpu_time': 0.0,
+        }
+
+    @property
+    def ratio(self):
+        with self._lock:
+            bytes_in = self.stats['bytes_in']
+            return self.stats['bytes_out'] / bytes_in if bytes_in else 1.0
+
+    def __call__(self, environ, start_response):
+        if (environ.get('REQUEST_METHOD') == 'HEAD'
+                or not accepts_gzip(environ.get('HTTP_ACCEPT_ENCODING', ''))):
+            return self.app(environ, start_response)
+
+        response = {}
+
+        def _start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+            response['exc_info'] = exc_info
+            # the real start_response is called once we know if we compress
+            return lambda data: response.setdefault('written', []).append(data)
+
+        app_iter = self.app(environ, _start_response)
+        return self._respond(app_iter, response, start_response)
+
+    def _compressible(self, status, headers):
+        if status[:3] in ('204', '206', '304') or int(status[:3]) < 200:
+            return False
+        content_type = ''
+        for name, value in headers:
+            name = name.lower()
+            if name == 'content-encoding':
+                return False
+            if name == 'content-type':
+                content_type = value.lower()
+            if name == 'content-length' and int(value) < self.min_size:
+                return False
+            if name == 'cache-control' and 'no-transform' in value.lower():
+                return False
+        return content_type.startswith(COMPRESSIBLE_MIMETYPES)
+
+    def _respond(self, app_iter, response, start_response):
+        iterator = iter(app_iter)
+        try:
+            buffered = []
+            if 'status' not in response:
+                # start_response can be deferred until the first chunk
+                for chunk in iterator:
+                    buffered.append(chunk)
+                    break
+            buffered[:0] = response.pop('written', [])
+            if 'status' not in response:
+                # an empty body and start_response never called,
+                # the server reports it as it would without us
+                yield from buffered
+                return
+            status, headers = response['status'], response['headers']
+            compress = self._compressible(status, headers)
+            has_length = any(n.lower() == 'content-length' for n, _ in headers)
+
+            if compress and not has_length:
+                # it's a streamed response, buffering until
+                # there's enough data to know if it's worth it
+                size = sum(len(chunk) for chunk in buffered)
+                for chunk in iterator:
+                    buffered.append(chunk)
+                    size += len(chunk)
+                    if size >= self.min_size:
+                        break
+                else:
+                    compress = size >= self.min_size
+                    if not compress:
+                        headers.append(('Content-Length', str(size)))
+
+            if not compress:
+                start_response(status, headers, response['exc_info'])
+                yield from buffered
+                yield from iterator
+                return
+
+            headers = [self._weak_etag(n, v) for n, v in headers
+                       if n.lower() != 'content-length']
+            headers.append(('Content-Encoding', 'gzip'))
+            headers.append(('Vary', 'Accept-Encoding'))
+            start_response(status, headers, response['exc_info'])
+            yield from self._compress(buffered, iterator,
+                                      flush=not has_length)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    @staticmethod
+    def _weak_etag(name, value):
+        # the encoded body isn't byte for byte the same anymore
+        # but still semantically equivalent for conditional requests
+        if name.lower() == 'etag' and not value.startswith('W/'):
+            value = 'W/' + value
+        return name, value
+
+    def _compress(self, buffered, iterator, flush):
+        # wbits 16 + MAX_WBITS to write a gzip header and trailer
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        bytes_in = bytes_out = 0
+        cpu_time = 0.0
+
+        def chunks():
+            yield from buffered
+            yield from iterator
+
+        for chunk in chunks():
+            if not chunk:
+                continue
+            start = time.thread_time()
+            data = compressor.compress(chunk)
+            if flush:
+                # streamed responses must reach the client as they are
+                # produced, so every chunk is flushed on its own
+                data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            cpu_time += time.thread_time() - start
+            bytes_in += len(chunk)
+            if data:
+                bytes_out += len(data)
+                yield data
+
+        start = time.thread_time()
+        data = compressor.flush()
+        cpu_time += time.thread_time() - start
+        bytes_out += len(data)
+        yield data
+
+        self._record(bytes_in, bytes_out, cpu_time)
+
+    def _record(self, bytes_in, bytes_out, cpu_time):
+        with self._lock:
+            self.stats['responses'] += 1
+            self.stats['bytes_in'] += bytes_in
+            self.stats['bytes_out'] += bytes_out
+            self.stats['cpu_time'] += cpu_time
+        logger.debug(
+            'gzip %d -> %d bytes (ratio %.2f) in %.2fms',
+            bytes_in, bytes_out,
+            bytes_out / bytes_in if bytes_in else 1.0, cpu_time * 1000
+        )
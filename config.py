@@ -1,3 +1,4 @@
+import json
 import os
 
 SECRET_KEY = os.getenv('SECRET_KEY')
@@ -15,3 +16,84 @@ SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URI') or 'sqlite:///:memory:'  # d
 
 # To suppress FSADeprecationWarning warning
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+# Shards, the venues of groups of states and their shows in other databases
+# as a JSON list [{"name": "east", "uri": "sqlite:///east.db", "states": ["NY"]}]
+# the position of a shard is in the ids of its venues so new ones go last,
+# the venues of the states of no shard stay in DATABASE_URI
+# create them with flask shards init
+SHARDS = json.loads(os.getenv('SHARDS') or '[]')
+SQLALCHEMY_BINDS = {shard['name']: shard['uri'] for shard in SHARDS}
+# threads querying the shards at once for the pages listing all of them
+SHARDS_WORKERS = int(os.getenv('SHARDS_WORKERS', 8))
+
+# Gzip compression of dynamic responses
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', 6))
+# responses smaller than that are not worth the CPU time
+GZIP_MIN_SIZE = int(os.getenv('GZIP_MIN_SIZE', 500))
+
+# Venues availability search
+AVAILABILITY_RESULTS_LIMIT = int(os.getenv('AVAILABILITY_RESULTS_LIMIT', 100))
+
+# Artists venues matching, maximum number of matches served at once
+MATCHES_LIMIT = int(os.getenv('MATCHES_LIMIT', 50))
+
+# Background tasks executor
+TASKS_WORKERS = int(os.getenv('TASKS_WORKERS', 2))
+TASKS_QUEUE_SIZE = int(os.getenv('TASKS_QUEUE_SIZE', 10000))
+# SQLite file keeping the pending jobs, they are only in memory without it
+TASKS_DB_PATH = os.getenv('TASKS_DB_PATH')
+
+# Logs, JSON lines written by a background thread
+LOG_FILE = os.getenv('LOG_FILE', 'error.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+# rotated by logrotate or the like, every worker reopens it once it's moved,
+# unless LOG_MAX_BYTES or LOG_ROTATE_WHEN (to midnight for instance) is set
+# then each worker rotates a file of its own, with its pid in the name,
+# as they would rename a shared one under each other
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 0))
+LOG_ROTATE_WHEN = os.getenv('LOG_ROTATE_WHEN')
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 5))
+# records that don't fit are dropped instead of blocking the requests
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+
+# Metrics, every worker writes its values in its own file in METRICS_DIR
+# and /metrics sums them, it should be emptied when the app is (re)deployed
+# a temporary directory is used when it isn't set, fine for a single process
+METRICS_DIR = os.getenv('METRICS_DIR')
+# seconds between copies of the caches, gzip, tasks and logs totals
+METRICS_REFRESH_INTERVAL = float(os.getenv('METRICS_REFRESH_INTERVAL', 1))
+
+# Closing the session once the view data is loaded and before rendering
+# so the connection isn't held while the template renders
+RELEASE_DB_BEFORE_RENDER = os.getenv('RELEASE_DB_BEFORE_RENDER', '1') == '1'
+
+# Limits of the routes in LIMITS, the searches as they are the most expensive,
+# rate and burst are the requests per second and at once of a client,
+# concurrency the requests of a route at once, lowered while their average
+# database time is over db_latency seconds, the ones waiting their turn more
+# than queue_timeout seconds get a 503 asking to retry after retry_after
+LIMITS_DEFAULTS = {
+    'rate': float(os.getenv('LIMITS_RATE', 2)),
+    'burst': int(os.getenv('LIMITS_BURST', 10)),
+    'concurrency': int(os.getenv('LIMITS_CONCURRENCY', 4)),
+    'queue_timeout': float(os.getenv('LIMITS_QUEUE_TIMEOUT', 0.5)),
+    'db_latency': float(os.getenv('LIMITS_DB_LATENCY', 0.25)),
+    'retry_after': int(os.getenv('LIMITS_RETRY_AFTER', 1)),
+}
+# the defaults overridden per route, a route set to null has no limits
+# LIMITS_ROUTES='{"/shows/search": {"rate": 0.5}, "/artists/search": null}'
+LIMITS = {
+    '/venues/search': {},
+    '/artists/search': {},
+    '/shows/search': {},
+}
+LIMITS.update(json.loads(os.getenv('LIMITS_ROUTES') or '{}'))
+# Proxies in front of the app adding to X-Forwarded-For, the client address
+# is the one the first of them was connected from, 0 when there are none
+# as the header could then be set by the clients themselves
+PROXY_COUNT = int(os.getenv('PROXY_COUNT', 0))
+
+# Directory the caches are saved to when a worker exits and restored from
+# when one starts, so restarts don't start from cold caches, unset disables it
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR')
@@ -57,3 +57,13 @@ class State(Enum):
     @classmethod
     def choices(cls):
         return [(choice.name, choice.value) for choice in cls]
+
+
+class Frequency(Enum):
+    weekly = 'Weekly'
+    monthly = 'Monthly'
+    dates = 'Specific dates'
+
+    @classmethod
+    def choices(cls):
+        return [(choice.name, choice.value) for choice in cls]
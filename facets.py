@@ -0,0 +1,88 @@
+from sqlalchemy import String, cast, func, literal, union_all
+
+from models import db, Genre
+from shards import shards
+
+FACETS = ('genre', 'state', 'city')
+# a city facet value is the city and its state, there's a Portland
+# in Oregon and one in Maine
+CITY_SEPARATOR = ', '
+
+
+def facet_filters(args):
+    """
+        facet values selected in the query string,
+        a genre that isn't an id is ignored
+    """
+    filters = {facet: args[facet] for facet in ('state', 'city')
+               if args.get(facet)}
+    genre = args.get('genre', type=int)
+    if genre is not None:
+        # compared to the facet values which are strings
+        filters['genre'] = str(genre)
+    return filters
+
+
+def apply_facet_filters(query, model, genres_table, fk, filters):
+    if 'genre' in filters:
+        query = query.filter(model.id.in_(
+            db.session.query(genres_table.c[fk]).filter(
+                genres_table.c.genre_id == int(filters['genre']))
+        ))
+    if 'state' in filters:
+        query = query.filter(model.state == filters['state'])
+    if 'city' in filters:
+        city, _, state = filters['city'].rpartition(CITY_SEPARATOR)
+        if city:
+            query = query.filter(model.city == city, model.state == state)
+        else:
+            query = query.filter(model.city == state)
+    return query
+
+
+def facet_counts(query, model, genres_table, fk, among=None):
+    """
+        counts per genre, state and city of the filtered query results
+        in a single UNION ALL of the three GROUP BY over the same ids
+        run in the shards among, every one by default, and summed
+        returns {facet: [(value, label, count)]} biggest counts first
+    """
+    ids = query.with_entities(model.id).subquery()
+
+    def grouped(facet, *columns):
+        value = columns[0] if len(columns) == 1 else \
+            columns[0] + CITY_SEPARATOR + columns[1]
+        return db.session.query(
+            literal(facet).label('facet'),
+            cast(value, String).label('value'),
+            cast(value, String).label('label'),
+            func.count().label('count'),
+        ).filter(model.id.in_(db.session.query(ids.c.id))).group_by(*columns)
+
+    # the names come from the cached genres map instead of a join
+    genres = db.session.query(
+        literal('genre').label('facet'),
+        cast(genres_table.c.genre_id, String).label('value'),
+        cast(genres_table.c.genre_id, String).label('label'),
+        func.count().label('count'),
+    ).filter(
+        genres_table.c[fk].in_(db.session.query(ids.c.id))
+    ).group_by(genres_table.c.genre_id)
+
+    statement = union_all(
+        genres.statement,
+        grouped('state', model.state).statement,
+        grouped('city', model.city, model.state).statement,
+    )
+    names = Genre.names()
+    totals = {facet: {} for facet in FACETS}
+    for rows in shards.execute(statement, among):
+        for facet, value, label, count in rows:
+            if facet == 'genre':
+                label = names.get(int(value), label)
+            total = totals[facet].get(value, (value, label, 0))
+            totals[facet][value] = (value, label, total[2] + count)
+    return {
+        facet: sorted(values.values(), key=lambda item: (-item[2], item[1]))
+        for facet, values in totals.items()
+    }
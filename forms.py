@@ -2,20 +2,25 @@ from datetime import datetime
 
 from flask import request
 from flask_wtf import FlaskForm
+from sqlalchemy.orm.attributes import set_committed_value
 from wtforms import (
     StringField, SelectField,
     SelectMultipleField, DateTimeField,
-    TextAreaField
+    TextAreaField, IntegerField, HiddenField
 )
 from wtforms.validators import (
     DataRequired, URL,
     Optional, Regexp,
-    ValidationError
+    ValidationError, NumberRange
 )
 
+import recurrence
 from app import db
-from enums import State
-from models import Venue, Artist, Genre
+from choices import choices
+from enums import State, Frequency
+from models import Venue, Artist, Genre, DEFAULT_SHOW_DURATION
+from scheduling import schedule_index
+from shards import shards
 
 
 def unique(model):
@@ -28,12 +33,16 @@ def unique(model):
         _id = request.view_args.get(f'{model.__model_name__}_id', None)
         exists = False
         if field.data:
-            exists = db.session.query(
-                model.query.filter(
-                    vars(model)[field.name] == field.data,
-                    model.id != _id
-                ).exists()
-            ).scalar()
+            # venues are unique across the shards, artists are all in main
+            exists = any(row[0] for rows in shards.execute(
+                db.session.query(
+                    model.query.filter(
+                        vars(model)[field.name] == field.data,
+                        model.id != _id
+                    ).exists()
+                ),
+                None if model is Venue else [shards.main]
+            ) for row in rows)
         if exists:
             raise ValidationError(f'This {field.name} has been used')
 
@@ -67,15 +76,190 @@ class ShowForm(FlaskForm):
         validators=[DataRequired()],
         default=datetime.now(),
     )
+    end_time = DateTimeField(
+        'end_time',
+        validators=[Optional()],  # defaults to DEFAULT_SHOW_DURATION
+    )
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         # Need to set it on every init as it's not a constant value
-        self.artist_id.choices = Artist.artists_choices()
-        self.venue_id.choices = Venue.venues_choices()
+        self.artist_id.choices = choices('artist')
+        self.venue_id.choices = choices('venue')
+
+    @property
+    def duration(self):
+        if self.end_time.data is None:
+            return DEFAULT_SHOW_DURATION
+        return self.end_time.data - self.start_time.data
+
+    def validate_end_time(self, field):
+        # an invalid start time already has its own error
+        if self.start_time.data is None:
+            return
+        if field.data <= self.start_time.data:
+            raise ValidationError('A show must end after it starts')
+
+    def occurrences(self):
+        return [self.start_time.data]
+
+    def validate_occurrences(self):
+        return True
+
+    def validate(self):
+        if not super().validate() or not self.validate_occurrences():
+            return False
+        return self.validate_schedule()
+
+    def validate_schedule(self):
+        """
+            reject shows overlapping each other or any show of the venue
+        """
+        venue_id = int(self.venue_id.data)
+        duration = self.duration
+        previous_end = None
+        for start in self.occurrences():
+            end = start + duration
+            if previous_end is not None and start < previous_end:
+                self.start_time.errors.append(
+                    f'Shows on {start} overlap each other')
+                return False
+            previous_end = end
+
+            show_id = schedule_index.conflict(venue_id, start, end)
+            if show_id is not None:
+                self.start_time.errors.append(
+                    f'The venue is already booked on {start} '
+                    f'by show {show_id}')
+                return False
+        return True
+
+    def populate_obj(self, obj):
+        super().populate_obj(obj)
+        if obj.end_time is None:
+            obj.end_time = obj.start_time + DEFAULT_SHOW_DURATION
+
+
+class RecurringShowForm(ShowForm):
+    frequency = SelectField(
+        'frequency',
+        validators=[DataRequired()],
+        choices=Frequency.choices()
+    )
+    interval = IntegerField(
+        'interval',
+        validators=[Optional(), NumberRange(min=1)],
+        default=1,
+    )
+    count = IntegerField(
+        'count',
+        validators=[
+            Optional(),
+            NumberRange(min=1, max=recurrence.MAX_OCCURRENCES)
+        ],
+    )
+    until = DateTimeField(
+        'until',
+        validators=[Optional()],
+    )
+    dates = TextAreaField(
+        'dates',
+        validators=[Optional()],  # one date time per line
+    )
+
+    def validate_occurrences(self):
+        # it can't be an inline validator as Optional stops the chain
+        # when the field is empty
+        if self.frequency.data != Frequency.dates.name \
+                and self.count.data is None and self.until.data is None:
+            self.count.errors.append('Set the number of shows or an end date')
+            return False
+        try:
+            self.occurrences()
+        except ValueError as e:
+            # too many of them, rather than listing only the first ones
+            field = self.dates if self.frequency.data == Frequency.dates.name \
+                else self.count
+            field.errors.append(str(e))
+            return False
+        return True
+
+    def validate_dates(self, field):
+        if self.frequency.data != Frequency.dates.name:
+            return
+        try:
+            field.parsed = recurrence.parse_dates(field.data or '')
+        except ValueError as e:
+            raise ValidationError(str(e))
+
+    def occurrences(self):
+        return recurrence.expand(
+            self.start_time.data,
+            self.frequency.data,
+            interval=self.interval.data or 1,
+            count=self.count.data,
+            until=self.until.data,
+            dates=getattr(self.dates, 'parsed', None),
+        )
+
+
+class AvailabilityForm(FlaskForm):
+    class Meta:
+        # it's a GET search form, there's nothing to protect
+        csrf = False
+
+    start = DateTimeField(
+        'start',
+        validators=[DataRequired()],
+    )
+    end = DateTimeField(
+        'end',
+        validators=[DataRequired()],
+    )
+    genre_id = SelectField(
+        'genre',
+        validators=[Optional()],
+        choices=[],
+    )
+    city = StringField(
+        'city',
+        validators=[Optional()],
+    )
+    state = SelectField(
+        'state',
+        validators=[Optional()],
+        choices=[('', 'Any state')] + State.choices()
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.genre_id.choices = [('', 'Any genre')] + Genre.genres_choices()
+
+    def validate_end(self, field):
+        # an invalid start already has its own error
+        if self.start.data is None:
+            return
+        if field.data <= self.start.data:
+            raise ValidationError('The end must be after the start')
+
+
+class VersionField(HiddenField):
+    """
+        version_id of the row when the edit form was loaded,
+        it's made the row loaded version so the UPDATE only matches
+        if no one else saved it in the meantime
+    """
+
+    def populate_obj(self, obj, name):
+        # empty for the create forms
+        if self.data:
+            set_committed_value(obj, name, int(self.data))
 
 
 class BaseForm(FlaskForm):
+    version_id = VersionField(
+        validators=[Optional(), Regexp('^[0-9]+$')]
+    )
     name = StringField(
         'name',
         validators=[DataRequired()]
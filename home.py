@@ -0,0 +1,151 @@
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+from caches import TopN
+from models import db, Artist, Venue, Show
+from shards import shards
+from tasks import executor, after_commit
+
+LIST_SIZE = 6
+# seconds before a list is reloaded from the database
+LIST_TTL = 300
+
+MODELS = {'artist': Artist, 'venue': Venue}
+
+
+def _entities(model, session=db.session):
+    return session.query(model.id, model.name, model.city, model.state,
+                         model.image_link, model.created_at)
+
+
+def _recent(model):
+    def load(size):
+        rows = shards.merged(
+            _entities(model).order_by(model.created_at.desc(),
+                                      model.id.desc()).limit(size),
+            key=_by_created_at, reverse=True,
+            shards=None if model is Venue else [shards.main]
+        )
+        return [dict(row) for row in rows[:size]]
+
+    return load
+
+
+def _trending_venues(size):
+    # the shows of a venue are in its shard so it's counted there
+    upcoming = Venue.upcoming_shows_count
+    rows = shards.merged(_entities(Venue).add_columns(
+        upcoming.label('upcoming_shows_count')
+    ).filter(upcoming > 0).order_by(upcoming.desc(), Venue.id).limit(size),
+        key=lambda row: (-row['upcoming_shows_count'], row['id']))
+    return [dict(row) for row in rows[:size]]
+
+
+def _trending_artists(size):
+    # the shows of an artist can be in every shard, their counts are summed
+    counts = shards.upcoming_shows_counts(Show.artist_id)
+    best = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:size]
+    rows = {row.id: row._asdict() for row in _entities(Artist).filter(
+        Artist.id.in_([artist_id for artist_id, _ in best]))}
+    return [dict(rows[artist_id], upcoming_shows_count=count)
+            for artist_id, count in best if artist_id in rows]
+
+
+def _by_created_at(item):
+    # the rows created before the column have the same created_at
+    return item['created_at'], item['id']
+
+
+def _by_upcoming_shows(item):
+    return item['upcoming_shows_count'], -item['id']
+
+
+LISTS = {
+    'recent_venues': TopN('home_recent_venues', _recent(Venue),
+                          _by_created_at, LIST_SIZE, LIST_TTL,
+                          lambda: shards.version(Venue)),
+    'recent_artists': TopN('home_recent_artists', _recent(Artist),
+                           _by_created_at, LIST_SIZE, LIST_TTL,
+                           lambda: shards.version(Artist)),
+    'trending_venues': TopN('home_trending_venues', _trending_venues,
+                            _by_upcoming_shows, LIST_SIZE, LIST_TTL,
+                            lambda: shards.version(Venue, Show)),
+    'trending_artists': TopN('home_trending_artists', _trending_artists,
+                             _by_upcoming_shows, LIST_SIZE, LIST_TTL,
+                             lambda: shards.version(Artist, Show)),
+}
+
+
+def home_lists():
+    """
+        the home page lists as they are in memory,
+        the stale ones are reloaded in the background
+        so the request never waits for their queries
+    """
+    lists = {}
+    for name, top in LISTS.items():
+        lists[name], reload = top.get()
+        if reload:
+            executor.submit(reload_home_list, name)
+    return lists
+
+
+@executor.task
+def reload_home_list(name):
+    LISTS[name].reload()
+
+
+@executor.task
+def home_entity_saved(kind, entity_id):
+    model = MODELS[kind]
+    session = shards.for_id(entity_id).session if kind == 'venue' \
+        else db.session
+    row = _entities(model, session).filter(model.id == entity_id).first()
+    if row is None:
+        return
+    item = row._asdict()
+    LISTS[f'recent_{kind}s'].upsert(item)
+    LISTS[f'trending_{kind}s'].update(entity_id, lambda i: dict(i, **item))
+
+
+@executor.task
+def home_entities_deleted(kind, entity_ids):
+    ids = {int(i) for i in entity_ids}
+    LISTS[f'recent_{kind}s'].remove(ids)
+    LISTS[f'trending_{kind}s'].remove(ids)
+    # the other side lost the shows with them, their counts are unknown
+    LISTS['trending_artists' if kind == 'venue' else 'trending_venues'] \
+        .expire()
+
+
+@executor.task
+def home_shows_listed(artist_id, venue_id, count=1):
+    def add(item):
+        return dict(item,
+                    upcoming_shows_count=item['upcoming_shows_count'] + count)
+
+    for top, item_id in ((LISTS['trending_artists'], artist_id),
+                         (LISTS['trending_venues'], venue_id)):
+        # the ones not in the list wait for the next reload
+        # which is right away if there's room for them
+        if not top.update(item_id, add) and len(top) < top.size:
+            top.expire()
+
+
+@event.listens_for(Artist, 'after_insert')
+@event.listens_for(Artist, 'after_update')
+@event.listens_for(Venue, 'after_insert')
+@event.listens_for(Venue, 'after_update')
+def _entity_saved(mapper, connection, target):
+    after_commit(home_entity_saved, target.__model_name__, target.id,
+                 session=object_session(target))
+
+
+@event.listens_for(Show, 'after_insert')
+def _show_listed(mapper, connection, target):
+    if target.start_time >= datetime.now():
+        # the form populates the ids as strings
+        after_commit(home_shows_listed, int(target.artist_id),
+                     int(target.venue_id), session=object_session(target))
@@ -0,0 +1,125 @@
+import hashlib
+import heapq
+
+from caches import LRUCache
+from models import db, Show, ArchivedShow, Venue, Artist
+
+PRODID = '-//Fyyur//Shows//EN'
+# rows fetched at once while streaming a feed
+YIELD_PER = 500
+
+# rendered VEVENT blocks, keyed by show id and everything they are made of
+# so a changed show or a renamed artist or venue is simply a new key
+events_cache = LRUCache('ical_events', maxsize=50000)
+
+
+def escape(text):
+    return (text or '').replace('\\', '\\\\').replace(';', '\\;') \
+        .replace(',', '\\,').replace('\n', '\\n')
+
+
+def fold(line):
+    """
+        lines longer than 75 octets are folded as RFC 5545 requires
+    """
+    data = line.encode('utf-8')
+    if len(data) <= 75:
+        return line + '\r\n'
+    parts = []
+    while data:
+        size = 75 if not parts else 74
+        # never splitting a multi bytes character
+        while size < len(data) and (data[size] & 0xC0) == 0x80:
+            size -= 1
+        parts.append(data[:size].decode('utf-8'))
+        data = data[size:]
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def format_time(value, utc=False):
+    """
+        a floating local time like the shows times, or a UTC one
+        with a trailing Z for the times stored with utcnow
+    """
+    return value.strftime('%Y%m%dT%H%M%S') + ('Z' if utc else '')
+
+
+def vevent(show_id, start_time, end_time, updated_at, artist_name,
+           venue_name, address, city, state):
+    key = (show_id, updated_at, artist_name, venue_name, address, city, state)
+    event = events_cache.get(key)
+    if event is None:
+        event = ''.join(fold(line) for line in (
+            'BEGIN:VEVENT',
+            f'UID:show-{show_id}@fyyur',
+            f'DTSTAMP:{format_time(updated_at, utc=True)}',
+            f'DTSTART:{format_time(start_time)}',
+            f'DTEND:{format_time(end_time)}',
+            f'SUMMARY:{escape(artist_name)} at {escape(venue_name)}',
+            f'LOCATION:{escape(f"{address}, {city}, {state}")}',
+            'END:VEVENT',
+        ))
+        events_cache.set(key, event)
+    return event
+
+
+def shows_query(model, column, value, session):
+    return session.query(
+        model.id, model.start_time, model.end_time, model.updated_at,
+        Artist.name, Venue.name, Venue.address, Venue.city, Venue.state
+    ).join(Artist, Artist.id == model.artist_id).join(
+        Venue, Venue.id == model.venue_id
+    ).filter(getattr(model, column) == value).order_by(model.start_time)
+
+
+def feed_version(calendar_name, column, value, sessions):
+    """
+        ETag and last modification time of a feed from aggregate queries
+        so unchanged feeds are answered without reading their shows,
+        sessions are the ones of the shards the shows can be in,
+        the artists and venues are in both as a renamed one
+        changes the events but not the shows
+    """
+    count, versions, last_modified = 0, 0, None
+    for model in (ArchivedShow, Show):
+        for session in sessions:
+            row = session.query(
+                db.func.count(model.id),
+                db.func.coalesce(db.func.sum(
+                    Artist.version_id + Venue.version_id), 0),
+                db.func.max(model.updated_at),
+                db.func.max(Artist.updated_at),
+                db.func.max(Venue.updated_at)
+            ).join(Artist, Artist.id == model.artist_id).join(
+                Venue, Venue.id == model.venue_id
+            ).filter(getattr(model, column) == value).one()
+            count += row[0]
+            versions += row[1]
+            last_modified = max(
+                (time for time in (last_modified, *row[2:]) if time),
+                default=None)
+    etag = hashlib.sha1(
+        f'{calendar_name}:{count}:{versions}:{last_modified}'.encode('utf-8')
+    ).hexdigest()
+    return etag, last_modified
+
+
+def calendar(calendar_name, column, value, sessions):
+    """
+        generator of the calendar lines, shows are streamed from the database
+        archived shows first as they are older than the ones still in shows,
+        the ones of every shard merged by start time
+    """
+    yield ''.join(fold(line) for line in (
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        f'PRODID:{PRODID}',
+        f'X-WR-CALNAME:{escape(calendar_name)}',
+    ))
+    for model in (ArchivedShow, Show):
+        for row in heapq.merge(*(
+            shows_query(model, column, value, session).yield_per(YIELD_PER)
+            for session in sessions
+        ), key=lambda row: row[1]):
+            yield vevent(*row)
+    yield 'END:VCALENDAR\r\n'
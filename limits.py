@@ -0,0 +1,193 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, g, request
+
+# every route limits, for the metrics
+registry = []
+
+# clients buckets kept per route, the full ones are the first forgotten
+MAX_CLIENTS = 10000
+# weight of the last request in the database time average
+LATENCY_WEIGHT = 0.2
+# the concurrency limit is multiplied by it while the database is slow
+DECREASE_FACTOR = 0.9
+
+
+class RateLimiter(object):
+    """
+        token bucket per client, a client can make burst requests at once
+        then rate requests per second
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        # {client: (tokens, updated)}, least recently used first
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _tokens(self, bucket, now):
+        if bucket is None:
+            return self.burst
+        tokens, updated = bucket
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def take(self, client):
+        """
+            0 if the client can make the request now, otherwise
+            the seconds until it can
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens = self._tokens(self._buckets.pop(client, None), now)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[client] = (tokens, now)
+            if len(self._buckets) > MAX_CLIENTS:
+                self._prune(now)
+        return wait
+
+    def _prune(self, now):
+        # a full bucket is the same as no bucket
+        for client, bucket in list(self._buckets.items()):
+            if self._tokens(bucket, now) >= self.burst:
+                del self._buckets[client]
+        while len(self._buckets) > MAX_CLIENTS:
+            self._buckets.popitem(last=False)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class ConcurrencyLimiter(object):
+    """
+        requests of a route at once, the others wait for their turn
+        up to queue_timeout seconds, the limit is lowered while the
+        requests average database time is over db_latency and raised
+        back by one every limit requests once it's under again
+    """
+
+    def __init__(self, concurrency, queue_timeout, db_latency):
+        self.max_limit = concurrency
+        self.limit = float(concurrency)
+        self.queue_timeout = queue_timeout
+        self.db_latency = db_latency
+        self.latency = 0.0
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+            True once the request can run, False if it waited too long
+        """
+        deadline = time.monotonic() + self.queue_timeout
+        with self._condition:
+            self.waiting += 1
+            try:
+                while self.active >= int(self.limit):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self, db_duration):
+        with self._condition:
+            self.active -= 1
+            self.latency += (db_duration - self.latency) * LATENCY_WEIGHT
+            if self.latency > self.db_latency:
+                self.limit = max(1.0, self.limit * DECREASE_FACTOR)
+            else:
+                self.limit = min(float(self.max_limit),
+                                 self.limit + 1 / self.limit)
+            self._condition.notify()
+
+
+class RouteLimits(object):
+    """
+        rate and concurrency limits of a route with the count
+        of the requests refused by each
+    """
+
+    def __init__(self, route, rate, burst, concurrency, queue_timeout,
+                 db_latency, retry_after):
+        self.route = route
+        self.rate_limiter = RateLimiter(rate, burst)
+        self.concurrency_limiter = ConcurrencyLimiter(
+            concurrency, queue_timeout, db_latency)
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self.stats = {
+            'rate': 0,
+            'queue': 0,
+        }
+        registry.append(self)
+
+    def _count(self, reason):
+        with self._lock:
+            self.stats[reason] += 1
+
+    def enter(self, client):
+        """
+            None if the request can go on, otherwise the response refusing it,
+            plain text as a page would take time to render when overloaded
+        """
+        wait = self.rate_limiter.take(client)
+        if wait:
+            self._count('rate')
+            return Response('Too many requests, slow down.\n', 429, {
+                'Retry-After': str(math.ceil(wait))
+            }, mimetype='text/plain')
+        if not self.concurrency_limiter.acquire():
+            self._count('queue')
+            return Response('The server is busy, try again later.\n', 503, {
+                'Retry-After': str(self.retry_after)
+            }, mimetype='text/plain')
+        return None
+
+    def leave(self, db_duration):
+        self.concurrency_limiter.release(db_duration)
+
+
+def init_limits(app):
+    """
+        limits of the routes in LIMITS, for the expensive ones like
+        the searches, a route set to None has none
+    """
+    limits = {
+        route: RouteLimits(route, **dict(app.config['LIMITS_DEFAULTS'],
+                                         **overrides))
+        for route, overrides in app.config['LIMITS'].items()
+        if overrides is not None
+    }
+
+    @app.before_request
+    def limit_request():
+        route = limits.get(request.url_rule.rule) if request.url_rule \
+            else None
+        if route is None:
+            return None
+        # the client one behind PROXY_COUNT proxies, see ProxyFix
+        refused = route.enter(request.remote_addr)
+        if refused is None:
+            g.limits_route = route
+        return refused
+
+    @app.teardown_request
+    def release_request(exception=None):
+        route = g.pop('limits_route', None)
+        if route is not None:
+            # the time measured by the metrics queries events
+            route.leave(g.get('db_duration', 0.0))
+
+    return limits
@@ -0,0 +1,156 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime
+from logging.handlers import (
+    QueueHandler, QueueListener,
+    RotatingFileHandler, TimedRotatingFileHandler, WatchedFileHandler
+)
+
+from flask import g, has_request_context, request
+
+# record attributes that are not worth repeating in every JSON line
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+    'message', 'asctime'
+}
+
+
+class RequestContextFilter(logging.Filter):
+    """
+        adds the request id, route and time spent so far to the records,
+        it must run on the request thread as the listener has no request
+    """
+
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = g.get('request_id')
+            record.method = request.method
+            record.route = request.url_rule.rule if request.url_rule \
+                else request.path
+            start = g.get('request_start')
+            if start is not None:
+                record.duration_ms = round(
+                    (time.perf_counter() - start) * 1000, 3)
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """
+        a JSON object per line, with the extra attributes of the record
+    """
+
+    def format(self, record):
+        data = {
+            'time': datetime.utcfromtimestamp(record.created).isoformat()
+            + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED and not key.startswith('_'):
+                data[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc_info'] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+        hands the records to the listener thread through a bounded queue,
+        when the disk can't keep up records are dropped and counted
+        instead of blocking the request
+    """
+
+    def __init__(self, maxsize):
+        super().__init__(queue.Queue(maxsize=maxsize))
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+    def prepare(self, record):
+        # the message and the traceback are rendered here as the arguments
+        # may change once the call returns, the JSON is left to the listener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def process_file(path):
+    """
+        error.log is error.1234.log for the process 1234
+    """
+    root, extension = os.path.splitext(path)
+    return f'{root}.{os.getpid()}{extension}'
+
+
+def file_handler(config):
+    if config['LOG_ROTATE_WHEN']:
+        return TimedRotatingFileHandler(
+            process_file(config['LOG_FILE']), when=config['LOG_ROTATE_WHEN'],
+            backupCount=config['LOG_BACKUP_COUNT'], delay=True)
+    if config['LOG_MAX_BYTES']:
+        return RotatingFileHandler(
+            process_file(config['LOG_FILE']),
+            maxBytes=config['LOG_MAX_BYTES'],
+            backupCount=config['LOG_BACKUP_COUNT'], delay=True)
+    # appending lines is safe from several processes, the rotation isn't
+    return WatchedFileHandler(config['LOG_FILE'], delay=True)
+
+
+def init_logging(app):
+    """
+        JSON logs written to a file by a listener thread,
+        the request threads only put the records in a queue
+        returns the queue handler, it counts the dropped records
+    """
+    handler = BoundedQueueHandler(app.config['LOG_QUEUE_SIZE'])
+    handler.addFilter(RequestContextFilter())
+    output = file_handler(app.config)
+    output.setFormatter(JSONFormatter())
+    listener = QueueListener(handler.queue, output,
+                             respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    # the root logger so the modules loggers end up in the file too
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(app.config['LOG_LEVEL'])
+    app.logger.setLevel(app.config['LOG_LEVEL'])
+
+    @app.before_request
+    def start_request():
+        g.request_start = time.perf_counter()
+        g.request_id = request.headers.get('X-Request-ID') \
+            or uuid.uuid4().hex
+
+    @app.after_request
+    def log_request(response):
+        if g.get('request_id'):
+            response.headers['X-Request-ID'] = g.request_id
+        app.logger.info('%s %s %s', request.method, request.path,
+                        response.status_code,
+                        extra={'status': response.status_code})
+        return response
+
+    return handler
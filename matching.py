@@ -0,0 +1,457 @@
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+from models import db, Artist, Venue, genres_artists, genres_venues
+from shards import shards
+from tasks import executor, after_commit
+
+GENRE_WEIGHT = 1.0
+STATE_WEIGHT = 1.0
+# on top of STATE_WEIGHT as the same city is always the same state
+CITY_WEIGHT = 2.0
+
+# rows x columns scored at once, 256 x 4096 pairs are a few MBs
+ROWS_BLOCK = 256
+COLUMNS_BLOCK = 4096
+# seconds before a build that never finished, like a dropped job,
+# is requested again
+BUILD_TIMEOUT = 60
+
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)],
+                           dtype=np.uint8)
+
+
+def popcount(bitsets):
+    """
+        set bits count of the last axis of an uint64 array
+    """
+    if hasattr(np, 'bitwise_count'):
+        # numpy >= 2.0 has a native popcount
+        return np.bitwise_count(bitsets).sum(axis=-1, dtype=np.int32)
+    counts = _POPCOUNT_TABLE[bitsets.view(np.uint8)]
+    return counts.reshape(bitsets.shape[:-1] + (-1,)).sum(axis=-1,
+                                                          dtype=np.int32)
+
+
+Arrays = namedtuple('Arrays', 'ids genres states cities active')
+
+
+class EntityMatrix(object):
+    """
+        seeking artists or venues as arrays, a row per entity
+        with the genres as a bitset indexed by genre id
+        and location codes shared with the other side
+    """
+
+    # whether snapshots share the arrays, they are then copied
+    # before a row they have is changed
+    _shared = False
+
+    def __init__(self, words=1):
+        self.size = 0
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._genres = np.zeros((0, words), dtype=np.uint64)
+        self._states = np.zeros(0, dtype=np.int32)
+        self._cities = np.zeros(0, dtype=np.int32)
+        # removed rows stay in place until the next full rebuild
+        self._active = np.zeros(0, dtype=bool)
+        self.rows = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    # the arrays have spare capacity, only their used part is exposed
+
+    @property
+    def ids(self):
+        return self._ids[:self.size]
+
+    @property
+    def genres(self):
+        return self._genres[:self.size]
+
+    @property
+    def states(self):
+        return self._states[:self.size]
+
+    @property
+    def cities(self):
+        return self._cities[:self.size]
+
+    @property
+    def active(self):
+        return self._active[:self.size]
+
+    def _grow(self):
+        # doubling so appending rows one by one is amortized O(1)
+        capacity = max(2 * len(self._ids), 64)
+        extra = capacity - len(self._ids)
+        self._ids = np.concatenate([self._ids, np.zeros(extra, np.int64)])
+        self._genres = np.vstack([
+            self._genres,
+            np.zeros((extra, self._genres.shape[1]), np.uint64)
+        ])
+        self._states = np.concatenate([self._states,
+                                       np.zeros(extra, np.int32)])
+        self._cities = np.concatenate([self._cities,
+                                       np.zeros(extra, np.int32)])
+        self._active = np.concatenate([self._active, np.zeros(extra, bool)])
+        self._shared = False
+
+    def _own(self):
+        if self._shared:
+            self._ids = self._ids.copy()
+            self._genres = self._genres.copy()
+            self._states = self._states.copy()
+            self._cities = self._cities.copy()
+            self._active = self._active.copy()
+            self._shared = False
+
+    def snapshot(self):
+        """
+            the used part of the arrays as they are now,
+            the next changes copy them instead of writing to them
+        """
+        self._shared = True
+        return Arrays(self.ids, self.genres, self.states, self.cities,
+                      self.active)
+
+    def resize_words(self, words):
+        if words > self._genres.shape[1]:
+            extra = np.zeros((len(self._ids), words - self._genres.shape[1]),
+                             dtype=np.uint64)
+            self._genres = np.hstack([self._genres, extra])
+
+    def set(self, entity_id, bitset, state, city):
+        row = self.rows.get(entity_id)
+        if row is None:
+            if self.size == len(self._ids):
+                self._grow()
+            row = self.size
+            self.size += 1
+            self.rows[entity_id] = row
+            self._ids[row] = entity_id
+        else:
+            self._own()
+        self._genres[row] = bitset
+        self._states[row] = state
+        self._cities[row] = city
+        self._active[row] = True
+
+    def remove(self, entity_id):
+        row = self.rows.pop(entity_id, None)
+        if row is not None:
+            self._own()
+            self._active[row] = False
+
+
+def score_block(genres_a, states_a, cities_a, genres_b, states_b, cities_b):
+    """
+        score of every pair of the two blocks as a (len(a), len(b)) matrix
+    """
+    overlap = popcount(genres_a[:, None, :] & genres_b[None, :, :])
+    scores = overlap.astype(np.float32) * GENRE_WEIGHT
+    scores += (states_a[:, None] == states_b[None, :]) * STATE_WEIGHT
+    scores += (cities_a[:, None] == cities_b[None, :]) * CITY_WEIGHT
+    # only artists and venues sharing at least a genre are a match
+    scores[overlap == 0] = 0
+    return scores
+
+
+def top_k(scores, k):
+    """
+        indexes and scores of the k best columns of every row, best first
+    """
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return (np.zeros((scores.shape[0], 0), dtype=np.int64),
+                np.zeros((scores.shape[0], 0), dtype=np.float32))
+    indexes = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    best = np.take_along_axis(scores, indexes, axis=1)
+    order = np.argsort(-best, axis=1, kind='stable')
+    return (np.take_along_axis(indexes, order, axis=1),
+            np.take_along_axis(best, order, axis=1))
+
+
+class MatchIndex(object):
+    """
+        the artists and venues matrices with the codes they share
+        and the version of the data they were loaded from
+    """
+
+    def __init__(self):
+        self.version = None
+        self.words = 1
+        self.states = {}
+        self.cities = {}
+        self.artists = EntityMatrix()
+        self.venues = EntityMatrix()
+
+    def _code(self, codes, key):
+        return codes.setdefault(key, len(codes))
+
+    def _bitset(self, genre_ids):
+        genre_ids = [int(g) for g in genre_ids]
+        words = max(genre_ids, default=0) // 64 + 1
+        if words > self.words:
+            self.words = words
+            self.artists.resize_words(words)
+            self.venues.resize_words(words)
+        bitset = np.zeros(self.words, dtype=np.uint64)
+        for genre_id in genre_ids:
+            bitset[genre_id // 64] |= np.uint64(1 << (genre_id % 64))
+        return bitset
+
+    def _set(self, matrix, entity_id, genre_ids, city, state):
+        matrix.set(
+            entity_id,
+            self._bitset(genre_ids),
+            self._code(self.states, state),
+            self._code(self.cities, (state, city.strip().lower())),
+        )
+
+    def matrix(self, model):
+        return self.artists if model is Artist else self.venues
+
+    def sides(self, model):
+        if model is Artist:
+            return self.artists, self.venues
+        return self.venues, self.artists
+
+    def load_side(self, model, table, fk):
+        seeking = db.session.query(
+            model.id, model.city, model.state
+        ).filter(model.seeking_description.isnot(None),
+                 model.seeking_description != '')
+        genres_query = db.session.query(
+            table.c[fk], table.c.genre_id
+        ).join(model, model.id == table.c[fk]).filter(
+            model.seeking_description.isnot(None),
+            model.seeking_description != ''
+        )
+        genres = {}
+        for rows in shards.execute(genres_query, Matcher._shards(model)):
+            for entity_id, genre_id in rows:
+                genres.setdefault(entity_id, []).append(genre_id)
+        for rows in shards.execute(seeking, Matcher._shards(model)):
+            for entity_id, city, state in rows:
+                self._set(self.matrix(model), entity_id,
+                          genres.get(entity_id, []), city, state)
+
+    def update(self, model, entity_id, seeking, genre_ids, city, state):
+        if seeking:
+            self._set(self.matrix(model), entity_id, genre_ids, city, state)
+        else:
+            self.matrix(model).remove(entity_id)
+
+    def remove(self, model, entity_ids):
+        for entity_id in entity_ids:
+            self.matrix(model).remove(int(entity_id))
+
+
+class Matcher(object):
+    """
+        artist venue matching on genres and location,
+        the index is built from the database by a background job
+        requested on first use then updated entity by entity
+        when they are edited, requests score a snapshot of its arrays
+        so they only hold the lock to take it
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None
+        self._build_requested_at = None
+        # changes made while the index is built, replayed on it
+        self._pending = []
+        # index restored from a snapshot, used if the data didn't change
+        self._snapshot = None
+
+    @staticmethod
+    def _shards(model):
+        # every artist is in the main database, the shards have copies
+        return shards.shards if model is Venue else [shards.main]
+
+    def _request_build(self):
+        # called with the lock held
+        now = time.monotonic()
+        if self._build_requested_at is not None and \
+                now - self._build_requested_at < BUILD_TIMEOUT:
+            return
+        self._build_requested_at = now
+        executor.submit(build_matches)
+
+    def load(self):
+        """
+            a new index from the snapshot if the data didn't change
+            or from the database, swapped in once it's complete
+        """
+        with self._lock:
+            snapshot, self._snapshot = self._snapshot, None
+            if self._build_requested_at is None:
+                self._build_requested_at = time.monotonic()
+        try:
+            version = shards.version(Artist, Venue)
+            if snapshot is not None and snapshot.version == version:
+                index = snapshot
+            else:
+                index = MatchIndex()
+                index.version = version
+                index.load_side(Artist, genres_artists, 'artist_id')
+                index.load_side(Venue, genres_venues, 'venue_id')
+        except Exception:
+            with self._lock:
+                self._build_requested_at = None
+            raise
+        with self._lock:
+            for change in self._pending:
+                change(index)
+            self._pending = []
+            self._index = index
+            self._build_requested_at = None
+
+    def dump(self):
+        """
+            the index as it was loaded, with the version of the data
+            it was loaded from so it's only restored if it's the same
+        """
+        with self._lock:
+            return self._index
+
+    def restore(self, snapshot):
+        with self._lock:
+            self._snapshot = snapshot
+
+    def _change(self, change):
+        with self._lock:
+            if self._index is not None:
+                change(self._index)
+            elif self._build_requested_at is not None:
+                # the build may have read the data before it changed
+                self._pending.append(change)
+
+    def update(self, entity):
+        """
+            keep the index in sync after an artist or venue is saved
+        """
+        model = Artist if isinstance(entity, Artist) else Venue
+        seeking = entity.seeking_venue if model is Artist \
+            else entity.seeking_talent
+        # read now as the change can be replayed once the session is gone
+        args = (model, entity.id, seeking,
+                [g.id for g in entity.genres_relation],
+                entity.city, entity.state)
+        self._change(lambda index: index.update(*args))
+
+    def remove(self, model, entity_ids):
+        entity_ids = list(entity_ids)
+        self._change(lambda index: index.remove(model, entity_ids))
+
+    def matches(self, model, entity_id, k=10):
+        """
+            the k best (id, score) matches from the other side
+            for a seeking artist or venue,
+            None until the index is built
+        """
+        with self._lock:
+            if self._index is None:
+                self._request_build()
+                return None
+            source, target = self._index.sides(model)
+            row = source.rows.get(entity_id)
+            if row is None:
+                return []
+            source, target = source.snapshot(), target.snapshot()
+        ids, scores = self._top_k(source, slice(row, row + 1), target, k)
+        return [(int(i), float(s))
+                for i, s in zip(ids[0], scores[0]) if s > 0]
+
+    def all_matches(self, model, k=10):
+        """
+            the k best matches of every seeking entity of a side
+            computed block by block to keep the memory bounded,
+            None until the index is built
+        """
+        with self._lock:
+            if self._index is None:
+                self._request_build()
+                return None
+            source, target = self._index.sides(model)
+            source, target = source.snapshot(), target.snapshot()
+        results = {}
+        for start in range(0, len(source.ids), ROWS_BLOCK):
+            rows = slice(start, start + ROWS_BLOCK)
+            ids, scores = self._top_k(source, rows, target, k)
+            for entity_id, active, row_ids, row_scores in zip(
+                    source.ids[rows], source.active[rows], ids, scores):
+                if active:
+                    results[int(entity_id)] = [
+                        (int(i), float(s))
+                        for i, s in zip(row_ids, row_scores) if s > 0
+                    ]
+        return results
+
+    @staticmethod
+    def _top_k(source, rows, target, k):
+        n = len(source.ids[rows])
+        best_ids = np.zeros((n, 0), dtype=np.int64)
+        best_scores = np.zeros((n, 0), dtype=np.float32)
+        for start in range(0, len(target.ids), COLUMNS_BLOCK):
+            columns = slice(start, start + COLUMNS_BLOCK)
+            scores = score_block(
+                source.genres[rows], source.states[rows], source.cities[rows],
+                target.genres[columns], target.states[columns],
+                target.cities[columns],
+            )
+            scores[:, ~target.active[columns]] = 0
+            # merging the block with the best so far
+            candidate_ids = np.hstack([
+                best_ids,
+                np.broadcast_to(target.ids[columns], scores.shape)
+            ])
+            candidate_scores = np.hstack([best_scores, scores])
+            indexes, best_scores = top_k(candidate_scores, k)
+            best_ids = np.take_along_axis(candidate_ids, indexes, axis=1)
+        return best_ids, best_scores
+
+
+matcher = Matcher()
+
+
+MODELS = {'artist': Artist, 'venue': Venue}
+
+
+@executor.task
+def build_matches():
+    matcher.load()
+
+
+@executor.task
+def refresh_matches(kind, entity_id):
+    session = shards.for_id(entity_id).session if kind == 'venue' \
+        else db.session
+    entity = session.query(MODELS[kind]).get(entity_id)
+    if entity is None:
+        matcher.remove(MODELS[kind], [entity_id])
+    else:
+        matcher.update(entity)
+
+
+@executor.task
+def remove_matches(kind, entity_ids):
+    matcher.remove(MODELS[kind], entity_ids)
+
+
+@event.listens_for(Artist, 'after_insert')
+@event.listens_for(Artist, 'after_update')
+@event.listens_for(Venue, 'after_insert')
+@event.listens_for(Venue, 'after_update')
+def _refresh_saved_entity(mapper, connection, target):
+    after_commit(refresh_matches, target.__model_name__, target.id,
+                 session=object_session(target))
@@ -0,0 +1,437 @@
+import glob
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Response, g, has_request_context, request
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import caches
+import limits
+from shards import shards
+from tasks import executor
+
+# seconds, from a cache hit to a slow page
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10,
+                   float('inf'))
+
+# every metric created, to render them
+registry = []
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class MmapValues(object):
+    """
+        float values of a process in a memory mapped file so every worker
+        writes its own file without any locking between processes,
+        the file is an 8 bytes used size then entries made of
+        the key size, the key padded to 8 bytes and the value as a double
+    """
+    INITIAL_SIZE = 64 * 1024
+
+    def __init__(self, path):
+        self._file = open(path, 'a+b')
+        if os.fstat(self._file.fileno()).st_size == 0:
+            self._file.truncate(self.INITIAL_SIZE)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._offsets = {}
+        self._used = struct.unpack_from('<Q', self._map, 0)[0] or 8
+        for key, value, offset in _entries(self._map, self._used):
+            self._offsets[key] = offset
+        # the writes of the threads of the process, held for a few µs
+        self._lock = threading.Lock()
+
+    def _offset(self, key):
+        offset = self._offsets.get(key)
+        if offset is None:
+            data = key.encode('utf-8')
+            padded = data + b' ' * (-(len(data) + 4) % 8)
+            size = 4 + len(padded) + 8
+            if self._used + size > len(self._map):
+                self._grow(self._used + size)
+            struct.pack_into(f'<i{len(padded)}sd', self._map, self._used,
+                             len(data), padded, 0.0)
+            offset = self._used + 4 + len(padded)
+            self._used += size
+            struct.pack_into('<Q', self._map, 0, self._used)
+            self._offsets[key] = offset
+        return offset
+
+    def _grow(self, needed):
+        size = len(self._map)
+        while size < needed:
+            size *= 2
+        self._map.close()
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+    def add(self, key, amount):
+        with self._lock:
+            offset = self._offset(key)
+            value = struct.unpack_from('<d', self._map, offset)[0]
+            struct.pack_into('<d', self._map, offset, value + amount)
+
+    def set(self, key, value):
+        with self._lock:
+            struct.pack_into('<d', self._map, self._offset(key), value)
+
+
+def _entries(data, used):
+    position = 8
+    while position < used:
+        size = struct.unpack_from('<i', data, position)[0]
+        padded = size + (-(size + 4) % 8)
+        key = bytes(data[position + 4:position + 4 + size]).decode('utf-8')
+        offset = position + 4 + padded
+        yield key, struct.unpack_from('<d', data, offset)[0], offset
+        position = offset + 8
+
+
+class Store(object):
+    """
+        the values file of the current process, opened again after a fork
+    """
+
+    def __init__(self):
+        self.directory = None
+        self._values = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def configure(self, directory):
+        self.directory = directory or tempfile.mkdtemp(prefix='metrics-')
+        os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def values(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    if self.directory is None:
+                        self.configure(None)
+                    self._values = MmapValues(
+                        os.path.join(self.directory, f'{os.getpid()}.db'))
+                    self._pid = os.getpid()
+        return self._values
+
+    def collect(self):
+        """
+            values summed over the files of every worker, the gauges
+            of the workers that aren't running anymore are left out
+        """
+        samples = {}
+        for path in glob.glob(os.path.join(self.directory, '*.db')):
+            alive = _is_alive(int(os.path.basename(path)[:-3]))
+            with open(path, 'rb') as file:
+                data = file.read()
+            if len(data) < 8:
+                continue
+            used = struct.unpack_from('<Q', data, 0)[0]
+            for key, value, _ in _entries(data, used):
+                kind, name, labels = json.loads(key)
+                if kind == 'gauge' and not alive:
+                    continue
+                key = (name, tuple(map(tuple, labels)))
+                samples[key] = samples.get(key, 0.0) + value
+        return samples
+
+
+store = Store()
+
+
+def _key(kind, name, labels):
+    return json.dumps([kind, name, sorted(labels.items())])
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        registry.append(self)
+
+    def render(self, samples):
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.kind}']
+        for (name, labels), value in sorted(samples.items()):
+            if name == self.name:
+                lines.append(
+                    f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        store.values.add(_key(self.kind, self.name, labels), amount)
+
+    def set_total(self, value, **labels):
+        """
+            for totals already counted somewhere else in the process
+        """
+        store.values.set(_key(self.kind, self.name, labels), value)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        store.values.set(_key(self.kind, self.name, labels), value)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        # a single bucket is counted, they are made cumulative when rendered
+        le = self.buckets[bisect_left(self.buckets, value)]
+        values = store.values
+        values.add(_key(self.kind, self.name + '_sum', labels), value)
+        values.add(_key(self.kind, self.name + '_bucket',
+                        dict(labels, le=_format_value(le))), 1)
+
+    def render(self, samples):
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.kind}']
+        series = {}
+        for (name, labels), value in samples.items():
+            if name == self.name + '_bucket':
+                labels = dict(labels)
+                le = labels.pop('le')
+                series.setdefault(tuple(sorted(labels.items())), {})[
+                    float(le)] = value
+        for labels, counts in sorted(series.items()):
+            total = 0.0
+            for le in self.buckets:
+                total += counts.get(le, 0.0)
+                bucket_labels = labels + (('le', _format_value(le)),)
+                lines.append(f'{self.name}_bucket'
+                             f'{_format_labels(bucket_labels)} {total}')
+            lines.append(f'{self.name}_sum{_format_labels(labels)} '
+                         f'{samples.get((self.name + "_sum", labels), 0.0)}')
+            lines.append(f'{self.name}_count{_format_labels(labels)} {total}')
+        return lines
+
+
+def render():
+    samples = store.collect()
+    lines = []
+    for metric in registry:
+        lines += metric.render(samples)
+    return '\n'.join(lines) + '\n'
+
+
+requests_total = Counter('fyyur_requests_total',
+                         'Requests by route, method and status.')
+request_duration = Histogram('fyyur_request_duration_seconds',
+                             'Request latency by route.')
+request_db_duration = Histogram('fyyur_request_db_duration_seconds',
+                                'Time spent in database queries per request'
+                                ' by route.')
+template_duration = Histogram('fyyur_template_render_seconds',
+                              'Template render time by template.')
+pool_checked_out = Gauge('fyyur_db_pool_checked_out',
+                         'Database connections checked out of the pool'
+                         ' by shard.')
+connection_hold_duration = Histogram(
+    'fyyur_db_connection_hold_seconds',
+    'Time a connection is checked out of the pool by route and shard.')
+pool_overflow = Gauge('fyyur_db_pool_overflow',
+                      'Database connections opened above the pool size'
+                      ' by shard.')
+cache_hits = Counter('fyyur_cache_hits_total', 'Cache hits by cache.')
+cache_misses = Counter('fyyur_cache_misses_total', 'Cache misses by cache.')
+cache_size = Gauge('fyyur_cache_entries', 'Cache entries by cache.')
+gzip_responses = Counter('fyyur_gzip_responses_total',
+                         'Responses compressed with gzip.')
+gzip_bytes_in = Counter('fyyur_gzip_bytes_in_total',
+                        'Bytes of the responses before compression.')
+gzip_bytes_out = Counter('fyyur_gzip_bytes_out_total',
+                         'Bytes of the responses after compression.')
+gzip_cpu = Counter('fyyur_gzip_cpu_seconds_total',
+                   'CPU time spent compressing responses.')
+tasks_depth = Gauge('fyyur_tasks_queue_depth',
+                    'Background tasks waiting to be run.')
+tasks_lag = Gauge('fyyur_tasks_lag_seconds',
+                  'Wait of the last background task before it started.')
+tasks_total = Counter('fyyur_tasks_total',
+                      'Background tasks by outcome.')
+logs_dropped = Counter('fyyur_logs_dropped_total',
+                       'Log records dropped as the logs queue was full.')
+requests_refused = Counter('fyyur_requests_refused_total',
+                           'Requests refused by the limits by route and'
+                           ' reason, rate or queue.')
+concurrency_limit = Gauge('fyyur_concurrency_limit',
+                          'Requests of a limited route allowed at once.')
+concurrency_active = Gauge('fyyur_concurrency_active',
+                           'Requests of a limited route running.')
+concurrency_waiting = Gauge('fyyur_concurrency_waiting',
+                            'Requests of a limited route waiting their turn.')
+
+
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            template_duration.observe(time.perf_counter() - start,
+                                      template=self.name or '<string>')
+
+
+def _route():
+    return request.url_rule.rule if request.url_rule else '<unmatched>'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _end_query(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    if has_request_context():
+        g.db_duration = g.get('db_duration', 0.0) + elapsed
+
+
+def instrument_pool(shard, pool):
+    """
+        connections checked out of the pool of a shard database
+        and the time they are held
+    """
+    def pool_changed():
+        # not every pool counts its connections, like SQLite's
+        if hasattr(pool, 'checkedout'):
+            pool_checked_out.set(pool.checkedout(), shard=shard)
+            pool_overflow.set(max(pool.overflow(), 0), shard=shard)
+
+    def checked_out(dbapi_connection, record, proxy):
+        # the route is taken now as the connection can be given back
+        # after the request context is gone, when the app context ends
+        route = _route() if has_request_context() else '<background>'
+        record.info['checked_out'] = (time.perf_counter(), route)
+        pool_changed()
+
+    def checked_in(dbapi_connection, record):
+        checked_out_at = record.info.pop('checked_out', None)
+        if checked_out_at is not None:
+            start, route = checked_out_at
+            connection_hold_duration.observe(time.perf_counter() - start,
+                                             route=route, shard=shard)
+        pool_changed()
+
+    event.listen(pool, 'checkout', checked_out)
+    event.listen(pool, 'checkin', checked_in)
+
+
+def init_metrics(app, gzip=None, log_handler=None):
+    """
+        the /metrics endpoint and the hooks feeding it,
+        totals kept by other parts of the app are copied
+        at most every METRICS_REFRESH_INTERVAL seconds
+    """
+    store.configure(app.config['METRICS_DIR'])
+    app.jinja_env.template_class = TimedTemplate
+    refreshed = [0.0]
+
+    def refresh():
+        for cache in caches.registry:
+            cache_hits.set_total(cache.hits, cache=cache.name)
+            cache_misses.set_total(cache.misses, cache=cache.name)
+            cache_size.set(len(cache), cache=cache.name)
+        if gzip is not None:
+            gzip_responses.set_total(gzip.stats['responses'])
+            gzip_bytes_in.set_total(gzip.stats['bytes_in'])
+            gzip_bytes_out.set_total(gzip.stats['bytes_out'])
+            gzip_cpu.set_total(gzip.stats['cpu_time'])
+        tasks_depth.set(executor.depth)
+        tasks_lag.set(executor.stats['lag'])
+        for outcome in ('submitted', 'completed', 'failed', 'dropped'):
+            tasks_total.set_total(executor.stats[outcome], outcome=outcome)
+        if log_handler is not None:
+            logs_dropped.set_total(log_handler.dropped)
+        for route in limits.registry:
+            for reason, count in route.stats.items():
+                requests_refused.set_total(count, route=route.route,
+                                           reason=reason)
+            limiter = route.concurrency_limiter
+            concurrency_limit.set(int(limiter.limit), route=route.route)
+            concurrency_active.set(limiter.active, route=route.route)
+            concurrency_waiting.set(limiter.waiting, route=route.route)
+        refreshed[0] = time.monotonic()
+
+    with app.app_context():
+        # the main database is db.engine, the shards have their own
+        pools = [(shard.name, shard.session.get_bind().pool)
+                 for shard in shards.shards]
+    for name, pool in pools:
+        instrument_pool(name, pool)
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.get('metrics_start')
+        if start is not None:
+            route = _route()
+            requests_total.inc(route=route, method=request.method,
+                               status=response.status_code)
+            request_duration.observe(time.perf_counter() - start,
+                                     route=route)
+            request_db_duration.observe(g.get('db_duration', 0.0),
+                                        route=route)
+        if time.monotonic() - refreshed[0] > \
+                app.config['METRICS_REFRESH_INTERVAL']:
+            refresh()
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        refresh()
+        return Response(
+            render(), content_type='text/plain; version=0.0.4; charset=utf-8')
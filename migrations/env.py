@@ -79,6 +79,13 @@ def run_migrations_online():
     )
 
     with connectable.connect() as connection:
+        # the app turns SQLite foreign keys on for every connection, then
+        # batch operations copying a table and dropping the old one would
+        # delete the rows referencing it with ON DELETE CASCADE,
+        # it's a no-op inside a transaction so it's set before it begins
+        if connection.dialect.name == 'sqlite':
+            connection.execute('PRAGMA foreign_keys=OFF')
+
         context.configure(
             connection=connection,
             target_metadata=target_metadata,
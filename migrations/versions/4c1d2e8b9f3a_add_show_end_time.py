@@ -0,0 +1,69 @@
+"""Add show end_time and venue double booking constraint
+
+Revision ID: 4c1d2e8b9f3a
+Revises: 17bb51fcd27c
+Create Date: 2026-10-19 09:12:31.482913
+
+"""
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+logger = logging.getLogger('alembic.runtime.migration')
+
+# revision identifiers, used by Alembic.
+revision = '4c1d2e8b9f3a'
+down_revision = '17bb51fcd27c'
+branch_labels = None
+depends_on = None
+
+
+# noinspection SqlNoDataSourceInspection,SqlResolve
+def upgrade():
+    is_postgresql = op.get_bind().dialect.name == 'postgresql'
+
+    op.add_column('shows', sa.Column('end_time', sa.DateTime(), nullable=True))
+    # existing shows get the default duration models.DEFAULT_SHOW_DURATION
+    if is_postgresql:
+        op.execute(
+            "UPDATE shows SET end_time = start_time + interval '3 hours'")
+    else:
+        op.execute(
+            "UPDATE shows SET end_time = datetime(start_time, '+3 hours')")
+    with op.batch_alter_table('shows') as batch_op:
+        batch_op.alter_column('end_time', existing_type=sa.DateTime(),
+                              nullable=False)
+
+    if is_postgresql:
+        # backs the in-process schedule index for concurrent bookings
+        # across workers, btree_gist is needed for venue_id WITH =
+        op.execute('CREATE EXTENSION IF NOT EXISTS btree_gist')
+        # shows booked before the check can overlap and the constraint
+        # couldn't be added, it's then only for the shows starting after
+        # the last of them ends, the older ones are left as they are
+        count, cutover = op.get_bind().execute(sa.text(
+            'SELECT count(*), max(greatest(a.end_time, b.end_time)) '
+            'FROM shows a JOIN shows b ON a.venue_id = b.venue_id '
+            'AND a.id < b.id AND a.start_time < b.end_time '
+            'AND b.start_time < a.end_time'
+        )).first()
+        where = ''
+        if count:
+            logger.warning('%s pairs of shows overlap, the ones starting '
+                           'before %s are left out of shows_venue_no_overlap',
+                           count, cutover)
+            where = f" WHERE (start_time >= '{cutover.isoformat()}')"
+        op.execute(
+            'ALTER TABLE shows ADD CONSTRAINT shows_venue_no_overlap '
+            'EXCLUDE USING gist '
+            '(venue_id WITH =, tsrange(start_time, end_time) WITH &&)'
+            + where
+        )
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('ALTER TABLE shows DROP CONSTRAINT shows_venue_no_overlap')
+    with op.batch_alter_table('shows') as batch_op:
+        batch_op.drop_column('end_time')
@@ -0,0 +1,37 @@
+"""Add venues and artists created_at for the recently listed ones
+
+Revision ID: a7c4e2f19d38
+Revises: f3a9c1d7b2e6
+Create Date: 2026-10-19 19:03:51.277604
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'a7c4e2f19d38'
+down_revision = 'f3a9c1d7b2e6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the server default only fills the existing rows,
+    # new ones are set by the model
+    for table in ('venues', 'artists'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.add_column(sa.Column(
+                'created_at', sa.DateTime(), nullable=False,
+                server_default=sa.func.current_timestamp()
+            ))
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column('created_at', server_default=None)
+        op.create_index(f'ix_{table}_created_at', table, ['created_at'],
+                        unique=False)
+
+
+def downgrade():
+    for table in ('artists', 'venues'):
+        op.drop_index(f'ix_{table}_created_at', table_name=table)
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('created_at')
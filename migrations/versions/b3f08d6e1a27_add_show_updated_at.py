@@ -0,0 +1,32 @@
+"""Add show updated_at used by the calendar feeds
+
+Revision ID: b3f08d6e1a27
+Revises: 9a7e3b51c2d4
+Create Date: 2026-10-19 11:26:05.730142
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'b3f08d6e1a27'
+down_revision = '9a7e3b51c2d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the server default only fills the existing rows,
+    # new ones are set by the model
+    with op.batch_alter_table('shows') as batch_op:
+        batch_op.add_column(sa.Column(
+            'updated_at', sa.DateTime(), nullable=False,
+            server_default=sa.func.current_timestamp()
+        ))
+    with op.batch_alter_table('shows') as batch_op:
+        batch_op.alter_column('updated_at', server_default=None)
+
+
+def downgrade():
+    with op.batch_alter_table('shows') as batch_op:
+        batch_op.drop_column('updated_at')
@@ -0,0 +1,34 @@
+"""Add venues and artists updated_at for the calendar feeds
+
+Revision ID: c2e9b7a41f05
+Revises: a7c4e2f19d38
+Create Date: 2026-10-19 21:37:14.905182
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'c2e9b7a41f05'
+down_revision = 'a7c4e2f19d38'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the server default only fills the existing rows,
+    # new ones are set by the model
+    for table in ('venues', 'artists'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.add_column(sa.Column(
+                'updated_at', sa.DateTime(), nullable=False,
+                server_default=sa.func.current_timestamp()
+            ))
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column('updated_at', server_default=None)
+
+
+def downgrade():
+    for table in ('artists', 'venues'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('updated_at')
@@ -0,0 +1,40 @@
+"""Never reuse the ids of archived shows on SQLite
+
+Revision ID: f3a9c1d7b2e6
+Revises: e61b4f2a9c35
+Create Date: 2026-10-19 18:12:07.640215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'f3a9c1d7b2e6'
+down_revision = 'e61b4f2a9c35'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # other databases take the ids from a sequence that never goes back
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    with op.batch_alter_table(
+            'shows', recreate='always',
+            table_kwargs={'sqlite_autoincrement': True}):
+        pass
+    # the sequence starts after the biggest copied show, the archived
+    # ones can be bigger than every show left
+    op.execute(sa.text("DELETE FROM sqlite_sequence WHERE name = 'shows'"))
+    op.execute(sa.text(
+        "INSERT INTO sqlite_sequence (name, seq) SELECT 'shows', max("
+        "(SELECT coalesce(max(id), 0) FROM shows), "
+        "(SELECT coalesce(max(id), 0) FROM shows_archive))"
+    ))
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    with op.batch_alter_table('shows', recreate='always'):
+        pass
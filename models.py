@@ -1,10 +1,30 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+
+from sqlite3 import Connection as SQLiteConnection
 
 from flask_sqlalchemy import SQLAlchemy, BaseQuery
+from sqlalchemy import DDL, event, inspect
+from sqlalchemy.engine import Engine
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.attributes import flag_modified
+
+from caches import CachedValue
 
 db = SQLAlchemy()
 
+# used when a show is listed without an end time
+DEFAULT_SHOW_DURATION = timedelta(hours=3)
+
+
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # SQLite ignores foreign keys (so ON DELETE CASCADE) unless asked to
+    if isinstance(dbapi_connection, SQLiteConnection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
 
 def setup_db(app):
     db.app = app
@@ -12,48 +32,169 @@ def setup_db(app):
     return db
 
 
-class Show(db.Model):
+def default_end_time(context):
+    return context.get_current_parameters()['start_time'] + \
+        DEFAULT_SHOW_DURATION
+
+
+class ShowMixin(object):
+    @hybrid_property
+    def artist_name(self):
+        return self.artist.name
+
+    @hybrid_property
+    def artist_image_link(self):
+        return self.artist.image_link
+
+    @hybrid_property
+    def venue_name(self):
+        return self.venue.name
+
+    @hybrid_property
+    def venue_image_link(self):
+        return self.venue.image_link
+
+    def __repr__(self):
+        v_name = self.venue_name
+        a_name = self.artist_name
+        return f'<{type(self).__name__} venue_name:{v_name} ' \
+               f'artist_name:{a_name}>'
+
+
+class Show(db.Model, ShowMixin):
     query: BaseQuery
     __tablename__ = 'shows'
+    __table_args__ = (
+        # bookings of a venue in a time range, used by double booking
+        # checks and the availability search anti-join
+        db.Index('ix_shows_venue_id_start_time', 'venue_id', 'start_time'),
+        # the ids of the archived shows are never given again, SQLite would
+        # reuse the biggest ones once they're moved to shows_archive
+        {'sqlite_autoincrement': True},
+    )
     id = db.Column(db.Integer, primary_key=True)
     artist_id = db.Column(db.Integer,
                           db.ForeignKey('artists.id', ondelete='CASCADE'))
     venue_id = db.Column(db.Integer,
                          db.ForeignKey('venues.id', ondelete='CASCADE'))
     start_time = db.Column(db.DateTime, nullable=False)
+    end_time = db.Column(db.DateTime, nullable=False, default=default_end_time)
+    updated_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow, onupdate=datetime.utcnow)
+    # every UPDATE checks the row is still at the version it was loaded with
+    # so concurrent edits fail with StaleDataError instead of overwriting
+    version_id = db.Column(db.Integer, nullable=False, server_default='1')
+    __mapper_args__ = {'version_id_col': version_id}
     artist = db.relationship(
         'Artist',
         lazy=True,
+        # deleting is left to the database ON DELETE CASCADE
+        # instead of loading every show to delete them one by one
         backref=db.backref('shows_relation', lazy='dynamic',
-                           cascade="all, delete")
+                           cascade="all, delete", passive_deletes=True)
     )
     venue = db.relationship(
         'Venue',
         lazy=True,
+        # deleting is left to the database ON DELETE CASCADE
+        # instead of loading every show to delete them one by one
         backref=db.backref('shows_relation', lazy='dynamic',
-                           cascade="all, delete")
+                           cascade="all, delete", passive_deletes=True)
     )
 
-    @hybrid_property
-    def artist_name(self):
-        return self.artist.name
-
-    @hybrid_property
-    def artist_image_link(self):
-        return self.artist.image_link
-
-    @hybrid_property
-    def venue_name(self):
-        return self.venue.name
+    @staticmethod
+    def bulk_insert(artist_id, venue_id, start_times,
+                    duration=DEFAULT_SHOW_DURATION, session=None, ids=None):
+        """
+            insert many shows with a single executemany INSERT
+            without building ORM objects, it's up to the caller to commit,
+            ids are the ones of the shard of the venue if it's not the main
+        """
+        shows = [
+            {
+                'artist_id': artist_id,
+                'venue_id': venue_id,
+                'start_time': start_time,
+                'end_time': start_time + duration
+            } for start_time in start_times
+        ]
+        if ids is not None:
+            for show, show_id in zip(shows, ids):
+                show['id'] = show_id
+        (session or db.session).execute(Show.__table__.insert(), shows)
+
+
+# the double booking constraint of the 4c1d2e8b9f3a migration
+# for the databases made with create_all, like the shards
+event.listen(Show.__table__, 'after_create', DDL(
+    'CREATE EXTENSION IF NOT EXISTS btree_gist'
+).execute_if(dialect='postgresql'))
+event.listen(Show.__table__, 'after_create', DDL(
+    'ALTER TABLE shows ADD CONSTRAINT shows_venue_no_overlap '
+    'EXCLUDE USING gist '
+    '(venue_id WITH =, tsrange(start_time, end_time) WITH &&)'
+).execute_if(dialect='postgresql'))
+
+
+class ArchivedShow(db.Model, ShowMixin):
+    """
+        past shows moved out of the shows table by flask shows archive
+        so upcoming shows queries only go through the small hot table
+    """
+    query: BaseQuery
+    __tablename__ = 'shows_archive'
+    __table_args__ = (
+        db.Index('ix_shows_archive_venue_id_start_time',
+                 'venue_id', 'start_time'),
+        db.Index('ix_shows_archive_artist_id_start_time',
+                 'artist_id', 'start_time'),
+    )
+    # keeping the id it had in the shows table
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    artist_id = db.Column(db.Integer,
+                          db.ForeignKey('artists.id', ondelete='CASCADE'))
+    venue_id = db.Column(db.Integer,
+                         db.ForeignKey('venues.id', ondelete='CASCADE'))
+    start_time = db.Column(db.DateTime, nullable=False)
+    end_time = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+    artist = db.relationship(
+        'Artist',
+        lazy=True,
+        backref=db.backref('archived_shows_relation', lazy='dynamic',
+                           cascade="all, delete", passive_deletes=True)
+    )
+    venue = db.relationship(
+        'Venue',
+        lazy=True,
+        backref=db.backref('archived_shows_relation', lazy='dynamic',
+                           cascade="all, delete", passive_deletes=True)
+    )
 
-    @hybrid_property
-    def venue_image_link(self):
-        return self.venue.image_link
+    COLUMNS = ('id', 'artist_id', 'venue_id', 'start_time', 'end_time',
+               'updated_at')
 
-    def __repr__(self):
-        v_name = self.venue_name
-        a_name = self.artist_name
-        return f'<Show venue_name:{v_name} artist_name:{a_name}>'
+    @staticmethod
+    def archive_batch(before, batch_size=1000, session=None):
+        """
+            move up to batch_size shows started before `before`
+            to the archive in its own transaction
+            returns how many were moved, 0 once there's nothing left
+        """
+        session = session or db.session
+        ids = [show_id for show_id, in session.query(Show.id).filter(
+            Show.start_time < before
+        ).order_by(Show.id).limit(batch_size)]
+        if not ids:
+            return 0
+        columns = [Show.__table__.c[name] for name in ArchivedShow.COLUMNS]
+        session.execute(ArchivedShow.__table__.insert().from_select(
+            ArchivedShow.COLUMNS,
+            db.select(columns).where(Show.id.in_(ids))
+        ))
+        session.execute(Show.__table__.delete().where(Show.id.in_(ids)))
+        session.commit()
+        return len(ids)
 
 
 # Adding Genre as a table for possible needs of adding more
@@ -64,19 +205,44 @@ class Genre(db.Model):
     id = db.Column(db.Integer, primary_key=True, unique=True)
     name = db.Column(db.String, nullable=False)
 
+    @staticmethod
+    def names():
+        """
+            cached genre names by id to show genres without joining them
+        """
+        return genre_names.get()
+
     @staticmethod
     def genres_choices():
-        return [(str(x.id), x.name) for x in
-                db.session.query(Genre.id, Genre.name).order_by('name')]
+        return sorted(((str(genre_id), name)
+                       for genre_id, name in Genre.names().items()),
+                      key=lambda choice: choice[1])
 
     @staticmethod
-    def get_genres_by_ids(ids: list):
-        return db.session.query(Genre).filter(Genre.id.in_(ids)).all()
+    def get_genres_by_ids(ids: list, session=None):
+        return (session or db.session).query(Genre).filter(
+            Genre.id.in_(ids)).all()
 
     def __repr__(self):
         return f"<Genre {self.id} {self.name}>"
 
 
+# {id: name} of every genre, they only change with migrations
+genre_names = CachedValue(
+    'genre_names',
+    lambda: dict(db.session.query(Genre.id, Genre.name)),
+    lambda: tuple(db.session.query(db.func.count(Genre.id),
+                                   db.func.max(Genre.id)).one())
+)
+
+
+@event.listens_for(Genre, 'after_insert')
+@event.listens_for(Genre, 'after_update')
+@event.listens_for(Genre, 'after_delete')
+def _genres_changed(mapper, connection, target):
+    genre_names.expire()
+
+
 genres_venues = db.Table(
     'genres_venues',
     db.Column('genre_id', db.Integer,
@@ -99,13 +265,29 @@ genres_artists = db.Table(
 
 
 class HybridShowsMixin(object):
+    # upcoming shows are only in the shows table
+    # past ones can also be in the archive
+    # the counts are correlated subqueries at the class level
+    # so they can be used in ORDER BY and WHERE of the listings
+
+    @classmethod
+    def _count(cls, model, *criteria):
+        fk = getattr(model, cls.__model_name__ + '_id')
+        return db.select([db.func.count(model.id)]).where(
+            db.and_(fk == cls.id, *criteria)).as_scalar()
+
     @hybrid_property
     def shows(self):
-        return self.shows_relation.all()
+        return self.shows_relation.all() + self.archived_shows_relation.all()
 
     @hybrid_property
     def shows_count(self):
-        return self.shows_relation.count()
+        return self.shows_relation.count() + \
+            self.archived_shows_relation.count()
+
+    @shows_count.expression
+    def shows_count(cls):
+        return cls._count(Show) + cls._count(ArchivedShow)
 
     @hybrid_property
     def upcoming_shows(self):
@@ -117,15 +299,26 @@ class HybridShowsMixin(object):
         return self.shows_relation.filter(
             Show.start_time >= datetime.now()).count()
 
+    @upcoming_shows_count.expression
+    def upcoming_shows_count(cls):
+        return cls._count(Show, Show.start_time >= datetime.now())
+
     @hybrid_property
     def past_shows(self):
         return self.shows_relation.filter(
-            Show.start_time <= datetime.now()).all()
+            Show.start_time <= datetime.now()).all() + \
+            self.archived_shows_relation.all()
 
     @hybrid_property
     def past_shows_count(self):
         return self.shows_relation.filter(
-            Show.start_time <= datetime.now()).count()
+            Show.start_time <= datetime.now()).count() + \
+            self.archived_shows_relation.count()
+
+    @past_shows_count.expression
+    def past_shows_count(cls):
+        return cls._count(Show, Show.start_time <= datetime.now()) + \
+            cls._count(ArchivedShow)
 
 
 class HybridGenresMixin(object):
@@ -139,12 +332,26 @@ class HybridGenresMixin(object):
 
     @genres_ids.setter
     def genres_ids(self, ids):
-        self.genres_relation = Genre.get_genres_by_ids(ids)
+        # from the session of the entity, a venue can be in a shard
+        session = object_session(self) or db.session
+        with session.no_autoflush:
+            genres = Genre.get_genres_by_ids(ids, session)
+        changed = set(genres) != set(self.genres_relation)
+        self.genres_relation = genres
+        if changed and inspect(self).persistent:
+            # the row itself isn't updated for its genres
+            # so its version_id wouldn't be bumped otherwise
+            flag_modified(self, 'name')
 
 
 class Venue(db.Model, HybridShowsMixin, HybridGenresMixin):
     query: BaseQuery
     __tablename__ = 'venues'
+    __table_args__ = (
+        db.Index('ix_venues_state_city', 'state', 'city'),
+        # the recently listed ones of the home page
+        db.Index('ix_venues_created_at', 'created_at'),
+    )
     # it's only used to get id its from the URI combined with _id
     __model_name__ = 'venue'
 
@@ -158,8 +365,17 @@ class Venue(db.Model, HybridShowsMixin, HybridGenresMixin):
     facebook_link = db.Column(db.String(120), nullable=True, unique=True)
     website = db.Column(db.String(120), nullable=True, unique=True)
     seeking_description = db.Column(db.String(1000), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow)
+    # the calendar feeds showing its name are modified with it
+    updated_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow, onupdate=datetime.utcnow)
+    # the edit forms carry it, see Show.version_id
+    version_id = db.Column(db.Integer, nullable=False, server_default='1')
+    __mapper_args__ = {'version_id_col': version_id}
+    # loaded only when used, selectinload it where it's rendered
     genres_relation = db.relationship('Genre', secondary=genres_venues,
-                                      lazy='joined')
+                                      lazy='select')
 
     @hybrid_property
     def seeking_talent(self):
@@ -167,11 +383,29 @@ class Venue(db.Model, HybridShowsMixin, HybridGenresMixin):
         return s is not None and s
 
     @staticmethod
-    def venues_choices():
-        return [
-            (str(v.id), f"ID:{v.id} {v.name}") for v in
-            db.session.query(Venue.id, Venue.name).order_by(Venue.id)
-        ]
+    def available(start, end, genre_id=None, city=None, state=None):
+        """
+            venues with no show overlapping [start, end)
+            as an anti-join on the (venue_id, start_time) index
+        """
+        busy = db.session.query(Show.id).filter(
+            Show.venue_id == Venue.id,
+            Show.start_time < end,
+            Show.end_time > start,
+        )
+        query = db.session.query(
+            Venue.id, Venue.name, Venue.city, Venue.state
+        ).filter(~busy.exists())
+        if genre_id:
+            query = query.join(
+                genres_venues, genres_venues.c.venue_id == Venue.id
+            ).filter(genres_venues.c.genre_id == genre_id)
+        if state:
+            query = query.filter(Venue.state == state)
+        if city:
+            # ilike without wildcards is a case insensitive equality
+            query = query.filter(Venue.city.ilike(city))
+        return query.order_by(Venue.id)
 
     def __repr__(self):
         return f"<Venue {self.id} {self.name}>"
@@ -180,6 +414,10 @@ class Venue(db.Model, HybridShowsMixin, HybridGenresMixin):
 class Artist(db.Model, HybridShowsMixin, HybridGenresMixin):
     query: BaseQuery
     __tablename__ = 'artists'
+    __table_args__ = (
+        # the recently listed ones of the home page
+        db.Index('ix_artists_created_at', 'created_at'),
+    )
     # it's only used to get id its from the URI combined with _id
     __model_name__ = 'artist'
 
@@ -192,8 +430,17 @@ class Artist(db.Model, HybridShowsMixin, HybridGenresMixin):
     facebook_link = db.Column(db.String(120), nullable=True, unique=True)
     website = db.Column(db.String(120), nullable=True, unique=True)
     seeking_description = db.Column(db.String(1000), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow)
+    # the calendar feeds showing its name are modified with it
+    updated_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow, onupdate=datetime.utcnow)
+    # the edit forms carry it, see Show.version_id
+    version_id = db.Column(db.Integer, nullable=False, server_default='1')
+    __mapper_args__ = {'version_id_col': version_id}
+    # loaded only when used, selectinload it where it's rendered
     genres_relation = db.relationship('Genre', secondary=genres_artists,
-                                      lazy='joined')
+                                      lazy='select')
 
     @hybrid_property
     def seeking_venue(self):
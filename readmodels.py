@@ -0,0 +1,79 @@
+from models import db, Artist, Venue
+
+
+class Summary(object):
+    """
+        what the listings and search results show of a venue or an artist,
+        a plain object made from a row so there's no identity map
+        or instrumented attributes, and no column that isn't shown
+    """
+    __slots__ = ('id', 'name', 'city', 'state', 'upcoming_shows_count')
+
+    def __init__(self, id, name, city, state, upcoming_shows_count=None):
+        self.id = id
+        self.name = name
+        self.city = city
+        self.state = state
+        self.upcoming_shows_count = upcoming_shows_count
+
+    def __repr__(self):
+        return f"<Summary {self.id} {self.name}>"
+
+
+def summary_query(model, upcoming_count=False):
+    """
+        the columns of a Summary, the upcoming shows count is a subquery
+        per row so it's only there if it's shown
+    """
+    columns = [model.id, model.name, model.city, model.state]
+    if upcoming_count:
+        columns.append(
+            model.upcoming_shows_count.label('upcoming_shows_count'))
+    return db.session.query(*columns)
+
+
+def summaries(rows):
+    """
+        Summary of every row of a summary_query executed as a Core
+        statement, by shards.merged usually, so the ORM doesn't make
+        its own row objects first
+    """
+    return [Summary(*row) for row in rows]
+
+
+class ShowSummary(object):
+    """
+        a show with its artist and venue names and the artist image
+        as the shows pages list them, in place of the Show hybrids
+        that lazy load the artist and the venue of every show
+    """
+    __slots__ = ('artist_id', 'artist_name', 'artist_image_link',
+                 'venue_id', 'venue_name', 'start_time')
+
+    def __init__(self, artist_id, artist_name, artist_image_link,
+                 venue_id, venue_name, start_time):
+        self.artist_id = artist_id
+        self.artist_name = artist_name
+        self.artist_image_link = artist_image_link
+        self.venue_id = venue_id
+        self.venue_name = venue_name
+        self.start_time = start_time
+
+    def __repr__(self):
+        return f"<ShowSummary venue_name:{self.venue_name} " \
+               f"artist_name:{self.artist_name}>"
+
+
+def show_summary_query(model):
+    """
+        the columns of a ShowSummary of Show or ArchivedShow
+    """
+    return db.session.query(
+        model.artist_id, Artist.name, Artist.image_link,
+        model.venue_id, Venue.name, model.start_time
+    ).join(Artist, Artist.id == model.artist_id).join(
+        Venue, Venue.id == model.venue_id)
+
+
+def show_summaries(rows):
+    return [ShowSummary(*row) for row in rows]
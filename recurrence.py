@@ -0,0 +1,66 @@
+from datetime import datetime, timedelta
+
+from dateutil.relativedelta import relativedelta
+
+from enums import Frequency
+
+# a weekly residency for 20 years, anything bigger is most likely a mistake
+MAX_OCCURRENCES = 1000
+
+
+def expand(start, frequency, interval=1, count=None, until=None, dates=None):
+    """
+        expand a recurrence rule into the sorted list of its start times
+        weekly and monthly rules stop after count occurrences or at until
+        whichever comes first, monthly ones keep the day of the month
+        and fall back to the last day for shorter months,
+        ValueError for more than MAX_OCCURRENCES of them
+    """
+    frequency = Frequency[frequency] if isinstance(frequency, str) \
+        else frequency
+    if frequency is Frequency.dates:
+        occurrences = sorted(set([start] + list(dates or [])))
+        _check_size(occurrences)
+        return occurrences
+
+    if count is None and until is None:
+        raise ValueError('a recurrence needs either count or until')
+    _check_size(range(count or 0))
+
+    occurrences = []
+    # one more than allowed for a rule stopping at until to be caught
+    for i in range(count or MAX_OCCURRENCES + 1):
+        if frequency is Frequency.weekly:
+            # adding to start every time instead of to the previous
+            # occurrence so monthly rules don't drift after a short month
+            occurrence = start + timedelta(weeks=i * interval)
+        else:
+            occurrence = start + relativedelta(months=i * interval)
+        if until is not None and occurrence > until:
+            break
+        occurrences.append(occurrence)
+    _check_size(occurrences)
+    return occurrences
+
+
+def _check_size(occurrences):
+    if len(occurrences) > MAX_OCCURRENCES:
+        raise ValueError(
+            f'At most {MAX_OCCURRENCES} shows can be listed at once')
+
+
+def parse_dates(text):
+    """
+        parse one date time per line, raising ValueError with the
+        offending line so it can be shown in the form
+    """
+    dates = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            dates.append(datetime.fromisoformat(line))
+        except ValueError:
+            raise ValueError(f'"{line}" is not a valid date')
+    return dates
@@ -0,0 +1,192 @@
+import threading
+from bisect import bisect_right
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import object_session
+
+from models import Show, Venue
+from shards import shards
+from tasks import on_commit
+
+
+# SQLSTATE of the PostgreSQL exclusion constraint shows_venue_no_overlap
+EXCLUSION_VIOLATION = '23P01'
+
+
+class BookingConflict(Exception):
+    """
+        a show of the venue overlaps one being booked
+    """
+
+    def __init__(self, start, show_id=None):
+        self.start = start
+        self.show_id = show_id
+        super().__init__(f'The venue is already booked on {start}'
+                         + (f' by show {show_id}' if show_id else ''))
+
+
+class VenueSchedule(object):
+    """
+        shows of a venue as intervals sorted by start time,
+        as bookings aren't allowed to overlap the ends are sorted too
+        so only the neighbours of a new interval can overlap with it
+        and checking a booking is a couple of binary searches,
+        shows booked before the check existed can overlap though,
+        then every show starting before the booking is looked at
+    """
+
+    def __init__(self, intervals=()):
+        self.intervals = sorted(tuple(interval) for interval in intervals)
+        self.overlapping = any(
+            previous[1] > interval[0] for previous, interval in
+            zip(self.intervals, self.intervals[1:])
+        )
+
+    def conflict(self, start, end):
+        """
+            id of a show overlapping [start, end) if any
+        """
+        i = bisect_right(self.intervals, (start,))
+        # the one starting right before, or any of them if the ends
+        # aren't sorted
+        for before in reversed(self.intervals[:i] if self.overlapping
+                               else self.intervals[i - 1:i]):
+            if before[1] > start:
+                return before[2]
+        if i < len(self.intervals) and self.intervals[i][0] < end:
+            return self.intervals[i][2]
+        return None
+
+    def add(self, start, end, show_id):
+        i = bisect_right(self.intervals, (start, end, show_id))
+        self.intervals.insert(i, (start, end, show_id))
+        self.overlapping = self.overlapping or (
+            i > 0 and self.intervals[i - 1][1] > start
+        ) or (
+            i + 1 < len(self.intervals) and self.intervals[i + 1][0] < end
+        )
+
+    def __len__(self):
+        return len(self.intervals)
+
+
+class ScheduleIndex(object):
+    """
+        per venue interval index rejecting double bookings early
+        in the form, it only knows the bookings of this process
+        so booking() checks again in the database, a venue schedule is loaded from the database the first time
+        it's needed then kept up to date by the create handlers,
+        anything else changing shows only has to invalidate it,
+        archived shows are in the past so they are never loaded
+    """
+
+    def __init__(self):
+        self._venues = {}
+        self._lock = threading.Lock()
+
+    def _load(self, venue_id):
+        # the shows of a venue are in the shard of the venue
+        session = shards.for_id(venue_id).session
+        return VenueSchedule(
+            session.query(Show.start_time, Show.end_time, Show.id).filter(
+                Show.venue_id == venue_id
+            )
+        )
+
+    def get(self, venue_id):
+        schedule = self._venues.get(venue_id)
+        if schedule is None:
+            schedule = self._load(venue_id)
+            with self._lock:
+                schedule = self._venues.setdefault(venue_id, schedule)
+        return schedule
+
+    def conflict(self, venue_id, start, end):
+        return self.get(venue_id).conflict(start, end)
+
+    def add(self, venue_id, start, end, show_id):
+        with self._lock:
+            # a venue that isn't loaded yet will be loaded with it
+            if venue_id in self._venues:
+                self._venues[venue_id].add(start, end, show_id)
+
+    def invalidate(self, venue_id=None):
+        with self._lock:
+            if venue_id is None:
+                self._venues.clear()
+            else:
+                self._venues.pop(venue_id, None)
+
+
+schedule_index = ScheduleIndex()
+
+
+def lock_venue(session, venue_id):
+    """
+        keep the other transactions from booking the venue
+        until the one of session ends
+    """
+    connection = session.connection(mapper=Show.__mapper__)
+    if connection.dialect.name == 'sqlite':
+        # SQLite has no row locks, the write lock is taken right away
+        # instead of at the INSERT, after the check
+        if not connection.connection.in_transaction:
+            connection.execute('BEGIN IMMEDIATE')
+    else:
+        session.query(Venue.id).filter(Venue.id == venue_id) \
+            .with_for_update().scalar()
+
+
+@contextmanager
+def booking(session, venue_id, intervals):
+    """
+        the shows of the venue overlapping intervals, (start, end) pairs,
+        are looked up in the database with the venue locked,
+        the index being only a pre-check as other workers book too,
+        the with block inserts the shows and commits,
+        BookingConflict for an overlap, also when it's the PostgreSQL
+        exclusion constraint finding it
+    """
+    venue_id = int(venue_id)
+    lock_venue(session, venue_id)
+    schedule = VenueSchedule(session.query(
+        Show.start_time, Show.end_time, Show.id
+    ).filter(
+        Show.venue_id == venue_id,
+        Show.start_time < max(end for _, end in intervals),
+        Show.end_time > min(start for start, _ in intervals)
+    ))
+    for start, end in intervals:
+        show_id = schedule.conflict(start, end)
+        if show_id is not None:
+            # booked by another worker, the index didn't know
+            schedule_index.invalidate(venue_id)
+            raise BookingConflict(start, show_id)
+    try:
+        yield
+    except IntegrityError as e:
+        if getattr(e.orig, 'pgcode', None) != EXCLUSION_VIOLATION:
+            raise
+        schedule_index.invalidate(venue_id)
+        raise BookingConflict(intervals[0][0]) from e
+
+
+def index_show(venue_id, start, end, show_id):
+    schedule_index.add(venue_id, start, end, show_id)
+
+
+def invalidate_schedules(venue_ids=None):
+    if venue_ids is None:
+        schedule_index.invalidate()
+    for venue_id in venue_ids or []:
+        schedule_index.invalidate(int(venue_id))
+
+
+@event.listens_for(Show, 'after_insert')
+def _index_inserted_show(mapper, connection, target):
+    # the form populates venue_id as a string
+    # right after the commit, not queued, so the next booking sees it
+    on_commit(index_show, int(target.venue_id), target.start_time,
+              target.end_time, target.id, session=object_session(target))
@@ -0,0 +1,348 @@
+import heapq
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from flask import g, has_request_context
+from sqlalchemy import event, Column, Integer, MetaData, String, Table
+from sqlalchemy.orm import Query
+
+from enums import State
+from models import db, Artist, Genre, Show, Venue, genres_artists
+
+# ids of the shard at position n are in [n * ID_RANGE, (n + 1) * ID_RANGE)
+# so the shard of a venue or a show is known from its id alone,
+# the ids are 32 bits integers so there's room for 21 shards
+ID_RANGE = 10 ** 8
+# the tables whose ids are given by the shards, with the tables
+# sharing the same ids, an archived show keeps its id
+ID_TABLES = {
+    'venues': ('venues',),
+    'shows': ('shows', 'shows_archive'),
+}
+
+# the last id given of every table of ID_TABLES in the other shards,
+# it only goes up so deleted and archived ids are never given again
+sequences = Table(
+    'shard_sequences', MetaData(),
+    Column('name', String(64), primary_key=True),
+    Column('value', Integer, nullable=False),
+)
+
+
+class Shard(object):
+    """
+        a database with the venues of a group of states and their shows,
+        the artists and the genres are copied to every shard
+        so the shows keep their foreign keys and their joins
+    """
+
+    def __init__(self, index, name, session, states=()):
+        self.index = index
+        self.name = name
+        self.session = session
+        self.states = frozenset(states)
+
+    def _last_id(self, name, execute):
+        last = self.index * ID_RANGE
+        for table_name in ID_TABLES[name]:
+            column = db.Model.metadata.tables[table_name].c.id
+            last = max(last, execute(
+                db.select([db.func.max(column)]).where(db.and_(
+                    column > self.index * ID_RANGE,
+                    column < (self.index + 1) * ID_RANGE
+                ))
+            ).scalar() or 0)
+        return last
+
+    def seed_sequences(self):
+        """
+            start the sequences after the biggest ids of the shard,
+            never going back on ids already given
+        """
+        execute = self.session.execute
+        for name in ID_TABLES:
+            last = self._last_id(name, execute)
+            value = execute(db.select([sequences.c.value]).where(
+                sequences.c.name == name)).scalar()
+            if value is None:
+                execute(sequences.insert().values(name=name, value=last))
+            elif value < last:
+                execute(sequences.update().where(
+                    sequences.c.name == name).values(value=last))
+
+    def next_ids(self, table, count=1, connection=None):
+        """
+            ids for new rows of a table from its sequence in the shard,
+            None in the main database as it gives them itself,
+            the UPDATE locks the sequence row until the transaction ends
+            so two transactions inserting at once get different ids
+        """
+        if self.index == 0:
+            return None
+        execute = (connection or self.session).execute
+        name = table.name
+        if not execute(sequences.update().where(
+                sequences.c.name == name
+        ).values(value=sequences.c.value + count)).rowcount:
+            # seeded by shards init, unless it wasn't run since
+            execute(sequences.insert().values(
+                name=name, value=self._last_id(name, execute) + count))
+        last = execute(db.select([sequences.c.value]).where(
+            sequences.c.name == name)).scalar()
+        return range(last - count + 1, last + 1)
+
+    def __repr__(self):
+        return f'<Shard {self.index} {self.name}>'
+
+
+class Shards(object):
+    """
+        venues and their shows partitioned by state over several databases,
+        a venue is read and written in the shard of its state
+        and the views listing them fan out to every shard
+        on a thread pool then merge the rows in the order they are sorted,
+        without SHARDS there's only the main database queried in place
+    """
+
+    def __init__(self):
+        self.app = None
+        self.shards = [Shard(0, 'main', db.session)]
+        self._states = {}
+        self._engines = {}
+        self._pool = None
+
+    def init_app(self, app):
+        self.app = app
+        self.shards = [Shard(0, 'main', db.session)]
+        for index, config in enumerate(app.config['SHARDS'], start=1):
+            engine = db.get_engine(app, bind=config['name'])
+            # without binds the session would send every table
+            # to the main database as they have no bind key
+            session = db.create_scoped_session({'bind': engine, 'binds': {}})
+            shard = Shard(index, config['name'], session, config['states'])
+            for state in shard.states:
+                # ValueError for a state that isn't one
+                State(state)
+                if state in self._states:
+                    raise ValueError(f'{state} is in more than one shard')
+                self._states[state] = shard
+            self._engines[engine] = shard
+            self.shards.append(shard)
+        if self.sharded:
+            self._pool = ThreadPoolExecutor(app.config['SHARDS_WORKERS'],
+                                            thread_name_prefix='shards')
+            app.teardown_appcontext(self._remove_sessions)
+
+    @property
+    def sharded(self):
+        return len(self.shards) > 1
+
+    @property
+    def main(self):
+        return self.shards[0]
+
+    @property
+    def others(self):
+        return self.shards[1:]
+
+    def _remove_sessions(self, exception=None):
+        for shard in self.others:
+            shard.session.remove()
+
+    def close(self):
+        """
+            give the connections of every session of this thread back
+        """
+        for shard in self.shards:
+            shard.session.close()
+
+    def for_state(self, state):
+        # the states of no shard are in the main database
+        return self._states.get(state, self.main)
+
+    def for_id(self, entity_id):
+        """
+            shard of a venue or a show, ids out of every range
+            are looked up in the main database where they aren't either
+        """
+        try:
+            index = int(entity_id) // ID_RANGE
+        except (TypeError, ValueError):
+            return self.main
+        return self.shards[index] if 0 <= index < len(self.shards) \
+            else self.main
+
+    def for_engine(self, engine):
+        return self._engines.get(engine, self.main)
+
+    def by_shard(self, ids):
+        """
+            {shard: ids} of venues or shows ids
+        """
+        groups = {}
+        for entity_id in ids:
+            groups.setdefault(self.for_id(entity_id), []).append(entity_id)
+        return groups
+
+    def among(self, state=None):
+        """
+            the shards a query filtered on a state has to run in
+        """
+        return [self.for_state(state)] if state else self.shards
+
+    def map(self, fn, shards=None):
+        """
+            [fn(shard) for every shard] run at once on the pool,
+            every call has its own app context so its own sessions
+            that are removed when it returns, so fn returns rows,
+            not ORM objects that would be detached by then,
+            the time waited for them is added to the request database time
+        """
+        shards = self.shards if shards is None else shards
+        if self._pool is None or len(shards) == 1:
+            return [fn(shard) for shard in shards]
+
+        def call(shard):
+            with self.app.app_context():
+                return fn(shard)
+
+        start = time.perf_counter()
+        results = list(self._pool.map(call, shards))
+        if has_request_context():
+            # the queries run outside of the request so the metrics
+            # queries events don't count them
+            g.db_duration = g.get('db_duration', 0.0) + \
+                time.perf_counter() - start
+        return results
+
+    def execute(self, statement, shards=None):
+        """
+            rows of a statement or a query run in every shard, a list per shard
+        """
+        if isinstance(statement, Query):
+            statement = statement.statement
+        return self.map(
+            lambda shard: shard.session.execute(statement).fetchall(), shards)
+
+    def merged(self, statement, key, reverse=False, shards=None):
+        """
+            rows of a sorted statement or query of every shard
+            merged in the same order, key gives what a row is sorted by
+        """
+        return list(heapq.merge(*self.execute(statement, shards),
+                                key=key, reverse=reverse))
+
+    def version(self, *models):
+        """
+            counts, last ids and versions sums of models in the shards
+            they are in, any insert, delete or edit changes it
+            so the caches of their rows can tell they are outdated
+        """
+        version = []
+        for model in models:
+            # every artist is in the main database, the shards have copies
+            among = [self.main] if model in (Artist, Genre) else self.shards
+            # genres have no version, they only change with migrations
+            versions = db.func.sum(model.version_id) \
+                if hasattr(model, 'version_id') else db.null()
+            rows = [row for rows in self.execute(db.session.query(
+                db.func.count(model.id), db.func.max(model.id), versions
+            ), among) for row in rows]
+            last_ids = [row[1] for row in rows if row[1] is not None]
+            sums = [row[2] for row in rows if row[2] is not None]
+            version.append((sum(row[0] for row in rows),
+                            max(last_ids, default=None),
+                            sum(sums) if sums else None))
+        return version
+
+    def upcoming_shows_counts(self, column):
+        """
+            {id: upcoming shows count} of the artists or venues
+            with upcoming shows, column is Show.artist_id or Show.venue_id
+        """
+        counts = Counter()
+        for rows in self.execute(db.session.query(
+                column, db.func.count(Show.id)
+        ).filter(Show.start_time >= datetime.now()).group_by(column)):
+            counts.update(dict(rows))
+        return counts
+
+    def copy_artists(self, ids=None):
+        """
+            copy artists with their genres from the main database
+            to the other shards, every one of them without ids
+        """
+        if not self.sharded:
+            return
+        table = Artist.__table__
+        artists = table.select()
+        genres = genres_artists.select()
+        if ids is not None:
+            artists = artists.where(table.c.id.in_(ids))
+            genres = genres.where(genres_artists.c.artist_id.in_(ids))
+        artists = [dict(row) for row in db.session.execute(artists)]
+        genres = [dict(row) for row in db.session.execute(genres)]
+
+        def copy(shard):
+            session = shard.session
+            # updated in place, deleting them would delete their shows
+            for artist in artists:
+                if not session.execute(table.update().where(
+                        table.c.id == artist['id']).values(artist)).rowcount:
+                    session.execute(table.insert().values(artist))
+            session.execute(genres_artists.delete().where(
+                genres_artists.c.artist_id.in_([a['id'] for a in artists])))
+            if genres:
+                session.execute(genres_artists.insert(), genres)
+            session.commit()
+
+        self.map(copy, self.others)
+
+    def delete_artists(self, ids):
+        """
+            delete the copies of artists, their shows in the shards with them
+        """
+        def delete(shard):
+            shard.session.execute(Artist.__table__.delete().where(
+                Artist.id.in_(ids)))
+            shard.session.commit()
+
+        self.map(delete, self.others)
+
+    def create_all(self):
+        """
+            tables of the other shards with their ids sequences
+            and their copies of the genres and artists,
+            the main database has its migrations
+        """
+        genres = [dict(row) for row in
+                  db.session.execute(Genre.__table__.select())]
+
+        def create(shard):
+            db.Model.metadata.create_all(shard.session.get_bind())
+            sequences.create(shard.session.get_bind(), checkfirst=True)
+            shard.seed_sequences()
+            table = Genre.__table__
+            for genre in genres:
+                if not shard.session.execute(table.update().where(
+                        table.c.id == genre['id']).values(genre)).rowcount:
+                    shard.session.execute(table.insert().values(genre))
+            shard.session.commit()
+
+        self.map(create, self.others)
+        self.copy_artists()
+
+
+shards = Shards()
+
+
+@event.listens_for(Venue, 'before_insert')
+@event.listens_for(Show, 'before_insert')
+def _shard_id(mapper, connection, target):
+    if target.id is None:
+        ids = shards.for_engine(connection.engine).next_ids(
+            mapper.local_table, connection=connection)
+        if ids is not None:
+            target.id = ids[0]
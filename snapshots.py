@@ -0,0 +1,127 @@
+import atexit
+import logging
+import mmap
+import os
+import pickle
+import struct
+import time
+
+from choices import CHOICES
+from home import LISTS
+from ical import events_cache
+from matching import matcher
+from models import genre_names
+
+logger = logging.getLogger(__name__)
+
+# changed with what the caches hold so older snapshots aren't restored
+MAGIC = b'FYYURSN4'
+# buffers are aligned so the numpy arrays restored on them are too
+ALIGNMENT = 64
+
+
+def snapshotted():
+    """
+        caches saved and restored, by name,
+        each one has dump() returning what to save or None and restore()
+        what's restored is only used once it's known to be up to date:
+        the ical events are keyed by the versions they are made of,
+        the others are saved with the version of the data they were
+        loaded from and compared to the current one before they are used
+    """
+    caches = {'ical_events': events_cache, 'matcher': matcher,
+              'genre_names': genre_names}
+    for name, top in LISTS.items():
+        caches[f'home_{name}'] = top
+    for kind, cache in CHOICES.items():
+        caches[f'{kind}_choices'] = cache
+    return caches
+
+
+def _align(position):
+    return position + (-position % ALIGNMENT)
+
+
+def write(path, payload):
+    """
+        pickle protocol 5 with the large buffers, like the numpy arrays,
+        written after the pickle instead of copied in it
+        the file is written aside then moved as many workers can save
+    """
+    buffers = []
+    data = pickle.dumps(payload, protocol=5, buffer_callback=buffers.append)
+    buffers = [buffer.raw() for buffer in buffers]
+    header = MAGIC + struct.pack(f'<QQ{len(buffers)}Q', len(data),
+                                 len(buffers), *map(len, buffers))
+    temporary = f'{path}.{os.getpid()}'
+    with open(temporary, 'wb') as file:
+        file.write(header)
+        file.write(data)
+        for buffer in buffers:
+            file.write(b'\0' * (_align(file.tell()) - file.tell()))
+            file.write(buffer)
+    os.replace(temporary, path)
+
+
+def read(path):
+    """
+        the payload of a snapshot, its buffers are copy on write views
+        of the memory mapped file so nothing is copied until it's changed
+    """
+    with open(path, 'rb') as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+    if mapped[:len(MAGIC)] != MAGIC:
+        raise ValueError(f'{path} is not a snapshot')
+    position = len(MAGIC)
+    size, count = struct.unpack_from('<QQ', mapped, position)
+    position += 16
+    sizes = struct.unpack_from(f'<{count}Q', mapped, position)
+    position += 8 * count
+    data = memoryview(mapped)[position:position + size]
+    position += size
+    buffers = []
+    for buffer_size in sizes:
+        position = _align(position)
+        buffers.append(memoryview(mapped)[position:position + buffer_size])
+        position += buffer_size
+    return pickle.loads(data, buffers=buffers)
+
+
+def save(directory):
+    for name, cache in snapshotted().items():
+        payload = cache.dump()
+        if payload is None:
+            continue
+        try:
+            write(os.path.join(directory, f'{name}.snapshot'), payload)
+        except (OSError, pickle.PicklingError):
+            logger.exception('%s snapshot could not be saved', name)
+
+
+def restore(directory):
+    start = time.perf_counter()
+    restored = 0
+    for name, cache in snapshotted().items():
+        path = os.path.join(directory, f'{name}.snapshot')
+        if not os.path.exists(path):
+            continue
+        try:
+            cache.restore(read(path))
+            restored += 1
+        except (OSError, ValueError, struct.error, pickle.UnpicklingError):
+            logger.exception('%s snapshot could not be restored', name)
+    logger.info('%s snapshots restored in %.1fms', restored,
+                (time.perf_counter() - start) * 1000)
+
+
+def init_snapshots(app):
+    """
+        caches restored from SNAPSHOT_DIR when the worker starts
+        and saved there when it exits
+    """
+    directory = app.config['SNAPSHOT_DIR']
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    restore(directory)
+    atexit.register(save, directory)
@@ -0,0 +1,332 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _decode(value):
+    if '__datetime__' in value:
+        return datetime.fromisoformat(value['__datetime__'])
+    return value
+
+
+class JobStore(object):
+    """
+        pending jobs in a local SQLite file so the ones queued
+        when a worker dies are run by the next one
+    """
+
+    def __init__(self, path):
+        self._connection = sqlite3.connect(path, check_same_thread=False,
+                                           isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, pid INTEGER NOT NULL, '
+                'name TEXT NOT NULL, args TEXT NOT NULL, '
+                'enqueued_at REAL NOT NULL)'
+            )
+
+    def add(self, jobs):
+        """
+            ids of the (name, args, enqueued_at) jobs saved,
+            in a single transaction so a single sync to disk
+        """
+        with self._lock:
+            self._connection.execute('BEGIN')
+            try:
+                ids = [self._connection.execute(
+                    'INSERT INTO jobs (pid, name, args, enqueued_at) '
+                    'VALUES (?, ?, ?, ?)',
+                    (os.getpid(), name, json.dumps(args, default=_encode),
+                     enqueued_at)
+                ).lastrowid for name, args, enqueued_at in jobs]
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+            return ids
+
+    def done(self, job_id):
+        with self._lock:
+            self._connection.execute('DELETE FROM jobs WHERE id = ?',
+                                     (job_id,))
+
+    def claim_orphans(self):
+        """
+            take over the jobs of processes that aren't running anymore
+        """
+        with self._lock:
+            pids = [pid for pid, in self._connection.execute(
+                'SELECT DISTINCT pid FROM jobs WHERE pid != ?', (os.getpid(),)
+            )]
+            jobs = []
+            for pid in pids:
+                if _is_alive(pid):
+                    continue
+                self._connection.execute(
+                    'UPDATE jobs SET pid = ? WHERE pid = ?',
+                    (os.getpid(), pid)
+                )
+                jobs += [
+                    (job_id, name, json.loads(args, object_hook=_decode),
+                     enqueued_at)
+                    for job_id, name, args, enqueued_at in
+                    self._connection.execute(
+                        'SELECT id, name, args, enqueued_at FROM jobs '
+                        'WHERE pid = ? ORDER BY id', (os.getpid(),)
+                    )
+                ]
+            return jobs
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class BackgroundExecutor(object):
+    """
+        in-process thread pool for work that isn't needed for the response,
+        the queue is bounded so a burst can't eat all the memory,
+        jobs that don't fit are dropped unless they are persisted
+        in which case the next worker start will run them
+        the threads are started by the process using them, on its first
+        request or job, as the ones of a process forking its workers
+        wouldn't be in the workers
+    """
+
+    def __init__(self):
+        self.app = None
+        self.tasks = {}
+        self.store = None
+        self._queue = None
+        # jobs waiting to be persisted before they are queued
+        self._incoming = None
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self.stats = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'dropped': 0,
+            # seconds between being queued and starting, of the last job
+            'lag': 0.0,
+        }
+
+    def init_app(self, app):
+        self.app = app
+        app.before_first_request(self.start)
+
+    def start(self):
+        """
+            start the threads of this process if they aren't,
+            and take over the persisted jobs of the dead ones
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            config = self.app.config
+            # what was inherited from a parent process is of no use
+            self._threads = []
+            self._queue = queue.Queue(maxsize=config['TASKS_QUEUE_SIZE'])
+            if config['TASKS_DB_PATH']:
+                self.store = JobStore(config['TASKS_DB_PATH'])
+                self._incoming = queue.Queue(
+                    maxsize=config['TASKS_QUEUE_SIZE'])
+                self._start_thread(self._persist, 'tasks-store')
+            for i in range(config['TASKS_WORKERS']):
+                self._start_thread(self._work, f'tasks-{i}')
+            self._pid = os.getpid()
+        if self.store is not None:
+            for job_id, name, args, enqueued_at in self.store.claim_orphans():
+                self._put((job_id, name, args, enqueued_at))
+
+    def _start_thread(self, target, name):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def task(self, fn):
+        """
+            register a function so it can be submitted,
+            it's looked up by name for the persisted jobs
+        """
+        self.tasks[f'{fn.__module__}.{fn.__qualname__}'] = fn
+        fn.task_name = f'{fn.__module__}.{fn.__qualname__}'
+        return fn
+
+    @property
+    def depth(self):
+        return sum(jobs.qsize() for jobs in (self._incoming, self._queue)
+                   if jobs is not None)
+
+    def _count(self, stat, value=1):
+        with self._lock:
+            self.stats[stat] += value
+
+    def submit(self, fn, *args):
+        enqueued_at = time.time()
+        if self.app is None:
+            # not initialized, like in scripts and commands
+            # that don't serve requests so have no caches to update
+            return
+        self.start()
+        self._count('submitted')
+        job = (None, fn.task_name, args, enqueued_at)
+        if self.store is None:
+            self._put(job)
+            return
+        # saved by the store thread, not by the request
+        try:
+            self._incoming.put_nowait(job)
+        except queue.Full:
+            self._count('dropped')
+            logger.warning('tasks queue is full, %s dropped', job[1])
+
+    def _put(self, job):
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            self._count('dropped')
+            logger.warning('tasks queue is full, %s dropped%s', job[1],
+                           ' until the next start' if job[0] else '')
+
+    def _persist(self):
+        """
+            save the submitted jobs then queue them, the ones submitted
+            meanwhile are saved together
+        """
+        while True:
+            jobs = [self._incoming.get()]
+            while len(jobs) < 100:
+                try:
+                    jobs.append(self._incoming.get_nowait())
+                except queue.Empty:
+                    break
+            stop = _STOP in jobs
+            jobs = [job for job in jobs if job is not _STOP]
+            try:
+                ids = self.store.add([job[1:] for job in jobs])
+            except Exception:
+                # still run, they are only lost if the worker dies
+                logger.exception('tasks could not be persisted')
+                ids = [None] * len(jobs)
+            for job_id, job in zip(ids, jobs):
+                self._put((job_id,) + job[1:])
+            for _ in range(len(jobs) + stop):
+                self._incoming.task_done()
+            if stop:
+                break
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is _STOP:
+                self._queue.task_done()
+                break
+            job_id, name, args, enqueued_at = job
+            with self._lock:
+                self.stats['lag'] = time.time() - enqueued_at
+            try:
+                with self.app.app_context():
+                    self.tasks[name](*args)
+                self._count('completed')
+            except Exception:
+                self._count('failed')
+                logger.exception('task %s failed', name)
+            finally:
+                if job_id is not None:
+                    self.store.done(job_id)
+                self._queue.task_done()
+
+    def join(self):
+        """
+            wait for every queued job to be done
+        """
+        if self._incoming is not None:
+            self._incoming.join()
+        if self._queue is not None:
+            self._queue.join()
+
+    def shutdown(self):
+        if self._pid != os.getpid():
+            return
+        if self._incoming is not None:
+            self._incoming.put(_STOP)
+            self._incoming.join()
+        for _ in range(self.app.config['TASKS_WORKERS']):
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._pid = None
+
+
+executor = BackgroundExecutor()
+
+
+def after_commit(fn, *args, session=None):
+    """
+        run fn(*args) in the background once the current transaction
+        of session, db.session by default, is committed,
+        nothing is run if it's rolled back
+    """
+    session = db.session if session is None else session
+    session.info.setdefault('after_commit', []).append((fn, args))
+
+
+def on_commit(fn, *args, session=None):
+    """
+        run fn(*args) in the committing thread as soon as the current
+        transaction of session is committed, for the in-process state
+        the next request has to see, so fn mustn't query the database
+    """
+    session = db.session if session is None else session
+    session.info.setdefault('on_commit', []).append((fn, args))
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def _submit_after_commit(session):
+    for fn, args in session.info.pop('on_commit', []):
+        try:
+            fn(*args)
+        except Exception:
+            # the transaction is committed anyway, the request goes on
+            logger.exception('%s after commit failed', fn.__qualname__)
+    for fn, args in session.info.pop('after_commit', []):
+        executor.submit(fn, *args)
+
+
+@event.listens_for(SignallingSession, 'after_soft_rollback')
+def _discard_after_rollback(session, previous_transaction):
+    session.info.pop('on_commit', None)
+    session.info.pop('after_commit', None)